@@ -2,35 +2,61 @@ import json
 import os
 import time
 import uuid
-from copy import deepcopy
+from urllib.parse import unquote
 
-import boto3
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import requests
+import plotly
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from dotenv import load_dotenv, find_dotenv
+from flask import Response, abort, jsonify, request
 from flask_caching import Cache
 
+from PIL import Image
+
 import dash_reusable_components as drc
+import metrics
+from storage import S3Storage, LocalStorage
+from upload import UploadError, ingest_upload, ingest_file
 from utils import STORAGE_PLACEHOLDER, GRAPH_PLACEHOLDER, \
-    IMAGE_STRING_PLACEHOLDER
-from utils import apply_filters, show_histogram, generate_lasso_mask, \
-    apply_enhancements
+    IMAGE_PATH_PLACEHOLDER, FILTERS_DICT, ENHANCEMENT_DICT
+from history import SessionHistory
+from state_store import SharedStateStore, STATE_TIMEOUT, get_prefix_keys
+from utils import show_histogram
+
+# Formats in which the interactive image can be displayed
+DISPLAY_FORMATS = ('jpeg', 'png')
 
-DEBUG = True
+# Whether each filter and enhancement applied on the whole default image is
+# precomputed when the worker starts
+PRECOMPUTE_DEFAULT_OPERATIONS = \
+    os.environ.get('PRECOMPUTE_DEFAULT_OPERATIONS', '').lower() == 'true'
 
 app = dash.Dash(__name__)
 server = app.server
 
+# The routes of the server are registered under the prefix of the routes of
+# Dash, while the URLs used by the browser start with the prefix of its
+# requests (they differ behind a proxy)
+ROUTES_PREFIX = app.config.routes_pathname_prefix
+REQUESTS_PREFIX = app.config.requests_pathname_prefix
+
+# Latency histograms of the pipeline stages, served at /metrics
+metrics.init_app(server)
+
+
+# The cache backends of image_cache.py store the images in a compact binary
+# format, and evict the entries based on their total size in bytes
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 512 * 1024 ** 2))
 
 if 'REDIS_URL' in os.environ:
     # Change caching to redis if hosted on dds
     cache_config = {
-        'CACHE_TYPE': 'redis',
+        'CACHE_TYPE': 'image_cache.redis',
         'CACHE_REDIS_URL': os.environ["REDIS_URL"],
-        'CACHE_THRESHOLD': 400
+        'CACHE_MAX_BYTES': CACHE_MAX_BYTES
     }
 # Local Conditions
 else:
@@ -41,48 +67,71 @@ else:
 
     # Caching with filesystem when served locally
     cache_config = {
-        'CACHE_TYPE': 'filesystem',
-        'CACHE_DIR': 'cache-directory',
+        'CACHE_TYPE': 'image_cache.filesystem',
+        'CACHE_DIR': os.environ.get('CACHE_DIR', 'cache-directory'),
+        'CACHE_MAX_BYTES': CACHE_MAX_BYTES
     }
 
-# S3 Client. It is used to store user images. The bucket name
-# is stored inside the utils file, the key is
-# the session id generated by uuid
+# Storage of the user images. The images are stored inside a bucket when
+# its name is given, and inside a local directory otherwise. The key is
+# the content hash of the image file
 access_key_id = os.environ.get('ACCESS_KEY_ID')
 secret_access_key = os.environ.get('SECRET_ACCESS_KEY')
 bucket_name = os.environ.get('BUCKET_NAME')
 
-s3 = boto3.client('s3',
-                  endpoint_url="https://storage.googleapis.com",
-                  aws_access_key_id=access_key_id,
-                  aws_secret_access_key=secret_access_key)
+if bucket_name:
+    image_storage = S3Storage(bucket_name, access_key_id, secret_access_key)
+else:
+    image_storage = LocalStorage(
+        os.environ.get('STORAGE_DIR', 'storage-directory'))
 
 # Caching
 cache = Cache()
 cache.init_app(app.server, config=cache_config)
 
+# The default image is stored once, and shared by all the new sessions. It
+# is also decoded once and kept in memory by every worker.
+DEFAULT_IMAGE_HANDLE = ingest_file(IMAGE_PATH_PLACEHOLDER, image_storage)
+DEFAULT_IMAGE = Image.open(IMAGE_PATH_PLACEHOLDER)
+DEFAULT_IMAGE.load()
 
-def store_image_string(string, key_name):
-    # Generate the POST attributes
-    post = s3.generate_presigned_post(
-        Bucket=bucket_name,
-        Key=key_name
-    )
 
-    files = {"file": string}
-    # Post the string file using requests
-    response = requests.post(post["url"], data=post["fields"], files=files)
-    return response
+def load_original_image(image_signature):
+    if image_signature == DEFAULT_IMAGE_HANDLE['image_signature']:
+        return DEFAULT_IMAGE.copy()
+
+    # Retrieve the original image from the storage, using its signature
+    with metrics.timed('storage_fetch'):
+        data = image_storage.get(image_signature)
+
+    # The image is decoded lazily, so its pixels are loaded explicitly
+    with metrics.timed('decode'):
+        im_pil = drc.bytes_to_pil(data)
+        im_pil.load()
+
+    return im_pil
+
+
+# Encodings and histograms of the default image states, precomputed by the
+# worker when it starts and served from memory, keyed by (state_key, output)
+# where the output is a display format or 'histogram'
+warm_outputs = {}
+
+# Image states shared by all the sessions
+state_store = SharedStateStore(cache, load_original=load_original_image)
+
+# Patches of the steps applied by each session, used to undo and redo them
+history = SessionHistory(cache, state_store)
 
 
 def serve_layout():
     # Generates a session ID
     session_id = str(uuid.uuid4())
 
-    # Post the image to the right key, inside the bucket named after the
-    # session ID
-    res = store_image_string(IMAGE_STRING_PLACEHOLDER, session_id)
-    print(res)
+    # Every session starts with the default image
+    storage = json.loads(STORAGE_PLACEHOLDER)
+    storage['image_signature'] = DEFAULT_IMAGE_HANDLE['image_signature']
+    storage['size'] = DEFAULT_IMAGE_HANDLE['size']
 
     # App Layout
     return html.Div([
@@ -125,6 +174,16 @@ def serve_layout():
                             accept='image/*'
                         ),
 
+                        # The files dropped inside the upload zone are posted
+                        # to the upload endpoint (see assets/upload.js), which
+                        # writes the handle of the stored image here
+                        dcc.Input(
+                            id='input-upload-handle',
+                            type='text',
+                            value='',
+                            style={'display': 'none'}
+                        ),
+
                         drc.NamedInlineRadioItems(
                             name='Selection Mode',
                             short='selection-mode',
@@ -150,17 +209,8 @@ def serve_layout():
                         drc.CustomDropdown(
                             id='dropdown-filters',
                             options=[
-                                {'label': 'Blur', 'value': 'blur'},
-                                {'label': 'Contour', 'value': 'contour'},
-                                {'label': 'Detail', 'value': 'detail'},
-                                {'label': 'Enhance Edge', 'value': 'edge_enhance'},
-                                {'label': 'Enhance Edge (More)', 'value': 'edge_enhance_more'},
-                                {'label': 'Emboss', 'value': 'emboss'},
-                                {'label': 'Find Edges', 'value': 'find_edges'},
-                                {'label': 'Sharpen', 'value': 'sharpen'},
-                                {'label': 'Smooth', 'value': 'smooth'},
-                                {'label': 'Smooth (More)',
-                                 'value': 'smooth_more'}
+                                {'label': filter.label, 'value': name}
+                                for name, filter in FILTERS_DICT.items()
                             ],
                             searchable=False,
                             placeholder='Basic Filter...'
@@ -209,6 +259,12 @@ def serve_layout():
                         html.Button(
                             'Undo',
                             id='button-undo',
+                            style={'margin-right': '10px', 'margin-top': '5px'}
+                        ),
+
+                        html.Button(
+                            'Redo',
+                            id='button-redo',
                             style={'margin-top': '5px'}
                         )
                     ]),
@@ -228,7 +284,7 @@ def serve_layout():
                             GRAPH_PLACEHOLDER,
                             html.Div(
                                 id='div-storage',
-                                children=STORAGE_PLACEHOLDER,
+                                children=json.dumps(storage),
                                 style={'display': 'none'}
                             )
                         ])
@@ -267,7 +323,7 @@ def add_action_to_stack(action_stack,
     action_stack.append(new_action)
 
 
-def undo_last_action(n_clicks, storage):
+def undo_last_action(n_clicks, storage, session_id):
     action_stack = storage['action_stack']
 
     if n_clicks is None:
@@ -275,8 +331,11 @@ def undo_last_action(n_clicks, storage):
 
     # If the stack isn't empty and the undo click count has changed
     elif len(action_stack) > 0 and n_clicks > storage['undo_click_count']:
-        # Remove the last action on the stack
-        action_stack.pop()
+        # Restore the previous state from the patch of the last action
+        history.undo(session_id, storage['image_signature'], action_stack)
+
+        # Move the last action of the stack to the redo stack
+        storage['redo_stack'].append(action_stack.pop())
 
         # Update the undo click count
         storage['undo_click_count'] = n_clicks
@@ -284,180 +343,266 @@ def undo_last_action(n_clicks, storage):
     return storage
 
 
-# Recursively retrieve the previous versions of the image by popping the
-# action stack
-@cache.memoize()
-def apply_actions_on_image(session_id,
-                           action_stack,
-                           filename,
-                           image_signature):
-    action_stack = deepcopy(action_stack)
-
-    # If we have arrived to the original image
-    if len(action_stack) == 0:
-        # Retrieve the url in which the image string is stored inside s3,
-        # using the session ID
-
-        url = s3.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={
-                'Bucket': bucket_name,
-                'Key': session_id
-            }
-        )
+def redo_last_action(n_clicks, storage, session_id):
+    redo_stack = storage['redo_stack']
+
+    if n_clicks is None:
+        storage['redo_click_count'] = 0
 
-        # A key replacement is required for URL pre-sign in gcp
+    # If the redo stack isn't empty and the redo click count has changed
+    elif len(redo_stack) > 0 and n_clicks > storage['redo_click_count']:
+        # Move the last undone action back to the action stack
+        storage['action_stack'].append(redo_stack.pop())
 
-        url = url.replace('AWSAccessKeyId', 'GoogleAccessId')
+        # Restore the next state from the patch of that action
+        history.redo(session_id, storage['image_signature'],
+                     storage['action_stack'])
+
+        # Update the redo click count
+        storage['redo_click_count'] = n_clicks
+
+    return storage
 
-        response = requests.get(url)
-        print(len(response.text))
-        im_pil = drc.b64_to_pil(response.text)
-        return im_pil
 
-    # Pop out the last action
-    last_action = action_stack.pop()
-    # Apply all the previous action_stack, and gets the image PIL
-    im_pil = apply_actions_on_image(
-        session_id,
-        action_stack,
-        filename,
-        image_signature
+def apply_actions_on_image(image_signature, action_stack):
+    """
+    Retrieves the image obtained by applying the action stack on the original
+    image. The intermediate states are shared by all the sessions, so only
+    the actions that were never applied on this image are replayed.
+    """
+    return state_store.get_image(image_signature, action_stack)
+
+
+def get_state_key(image_signature, action_stack):
+    """
+    Computes the key identifying an image state, i.e. an original image with
+    a given action stack applied on it.
+    """
+    return get_prefix_keys(image_signature, action_stack)[-1]
+
+
+def register_image_state(image_signature, action_stack):
+    """
+    Saves the arguments required to rebuild an image state inside the cache,
+    so it can be served by its key without sending the stack again. The
+    registration never expires, and the callbacks serving a state register it
+    again in case the cache backend dropped it anyway.
+    :return: The key of the image state
+    """
+    state_key = get_state_key(image_signature, action_stack)
+
+    cache.set('image-state-' + state_key, {
+        'image_signature': image_signature,
+        'action_stack': action_stack
+    }, timeout=0)
+
+    return state_key
+
+
+def load_image_state(state_key):
+    """
+    Retrieves the image corresponding to a registered state key, using the
+    shared image states.
+    :return: The PIL image, or None if the state is unknown
+    """
+    state = cache.get('image-state-' + state_key)
+
+    if state is None:
+        return None
+
+    return apply_actions_on_image(
+        state['image_signature'],
+        state['action_stack']
     )
-    im_size = im_pil.size
-
-    # Apply the rest of the action_stack
-    operation = last_action['operation']
-    selectedData = last_action['selectedData']
-    type = last_action['type']
-
-    # Select using Lasso
-    if selectedData and 'lassoPoints' in selectedData:
-        selection_mode = 'lasso'
-        selection_zone = generate_lasso_mask(im_pil, selectedData)
-    # Select using rectangular box
-    elif selectedData and 'range' in selectedData:
-        selection_mode = 'select'
-        lower, upper = map(int, selectedData['range']['y'])
-        left, right = map(int, selectedData['range']['x'])
-        # Adjust height difference
-        height = im_size[1]
-        upper = height - upper
-        lower = height - lower
-        selection_zone = (left, upper, right, lower)
-    # Select the whole image
-    else:
-        selection_mode = 'select'
-        selection_zone = (0, 0) + im_size
-
-    # Apply the filters
-    if type == 'filter':
-        apply_filters(
-            image=im_pil,
-            zone=selection_zone,
-            filter=operation,
-            mode=selection_mode
-        )
-    elif type == 'enhance':
-        enhancement = operation['enhancement']
-        factor = operation['enhancement_factor']
-
-        apply_enhancements(
-            image=im_pil,
-            zone=selection_zone,
-            enhancement=enhancement,
-            enhancement_factor=factor,
-            mode=selection_mode
-        )
 
-    return im_pil
+
+def image_state_url(state_key, enc_format):
+    return f'{REQUESTS_PREFIX}image-state/{state_key}.{enc_format}'
+
+
+@cache.memoize(timeout=STATE_TIMEOUT)
+def encode_image_state(state_key, enc_format):
+    metrics.mark_computed()
+
+    im_pil = load_image_state(state_key)
+    if im_pil is None:
+        return None
+
+    return drc.pil_to_display_bytes(im_pil, enc_format=enc_format)
+
+
+@cache.memoize(timeout=STATE_TIMEOUT)
+def compute_histogram(state_key):
+    metrics.mark_computed()
+
+    im_pil = load_image_state(state_key)
+    if im_pil is None:
+        return None
+
+    # The figure is cached as plain JSON data, since the plotly graph objects
+    # cannot be unpickled
+    with metrics.timed('histogram'):
+        figure = show_histogram(im_pil)
+    return json.loads(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+# Uploaded files are streamed to this endpoint rather than sent as base64
+# strings through the callbacks. It only returns a handle to the stored image.
+@server.route(f'{ROUTES_PREFIX}upload', methods=['POST'])
+def upload_image():
+    try:
+        handle = ingest_upload(request.stream, image_storage)
+    except UploadError as e:
+        return jsonify(error=str(e)), e.status_code
+
+    handle['filename'] = unquote(request.headers.get('X-Filename', ''))
+
+    server.logger.info("%s added to the storage.", handle['filename'])
+
+    return jsonify(handle)
+
+
+# The displayed image is served by URL rather than embedded inside the
+# figure, so that updating the layout of the figure (e.g. the drag mode or
+# the encoding format) does not transfer the image through the callbacks.
+@server.route(f'{ROUTES_PREFIX}image-state/<state_key>.<enc_format>')
+def serve_image_state(state_key, enc_format):
+    if enc_format not in DISPLAY_FORMATS:
+        abort(404)
+
+    encoded = warm_outputs.get((state_key, enc_format))
+    if encoded is not None:
+        metrics.count_cache('encoded_image', 'hit')
+    else:
+        with metrics.cache_lookup('encoded_image'):
+            encoded = encode_image_state(state_key, enc_format)
+    if encoded is None:
+        abort(404)
+
+    # A state key always maps to the same image, so it can be cached freely
+    return Response(
+        encoded,
+        mimetype=f'image/{enc_format}',
+        headers={'Cache-Control': 'public, max-age=86400'}
+    )
 
 
 @app.callback(Output('interactive-image', 'figure'),
-              [Input('radio-selection-mode', 'value')],
-              [State('interactive-image', 'figure')])
-def update_selection_mode(selection_mode, figure):
-    if figure:
-        figure['layout']['dragmode'] = selection_mode
+              [Input('radio-selection-mode', 'value'),
+               Input('radio-encoding-format', 'value')],
+              [State('interactive-image', 'figure'),
+               State('div-storage', 'children')])
+def update_image_display(selection_mode, enc_format, figure, storage):
+    if not figure:
+        raise PreventUpdate
+
+    # Only the layout is modified, the image itself is fetched from its URL.
+    # The state is registered again, so the URL in the new format can always
+    # be served.
+    storage = json.loads(storage)
+    state_key = register_image_state(
+        storage['image_signature'],
+        storage['action_stack']
+    )
+
+    figure['layout']['dragmode'] = selection_mode
+    figure['layout']['images'][0]['source'] = \
+        image_state_url(state_key, enc_format)
+
     return figure
 
 
 @app.callback(Output('graph-histogram-colors', 'figure'),
-              [Input('interactive-image', 'figure')])
-def update_histogram(figure):
-    # Retrieve the image stored inside the figure
-    enc_str = figure['layout']['images'][0]['source'].split(';base64,')[-1]
-    # Creates the PIL Image object from the b64 png encoding
-    im_pil = drc.b64_to_pil(string=enc_str)
+              [Input('div-storage', 'children')])
+def update_histogram(storage):
+    storage = json.loads(storage)
+
+    state_key = register_image_state(
+        storage['image_signature'],
+        storage['action_stack']
+    )
+    histogram = warm_outputs.get((state_key, 'histogram'))
+    if histogram is not None:
+        metrics.count_cache('histogram', 'hit')
+    else:
+        with metrics.cache_lookup('histogram'):
+            histogram = compute_histogram(state_key)
 
-    return show_histogram(im_pil)
+    if histogram is None:
+        raise PreventUpdate
+
+    return histogram
 
 
 @app.callback(Output('div-interactive-image', 'children'),
-              [Input('upload-image', 'contents'),
+              [Input('input-upload-handle', 'value'),
                Input('button-undo', 'n_clicks'),
+               Input('button-redo', 'n_clicks'),
                Input('button-run-operation', 'n_clicks')],
               [State('interactive-image', 'selectedData'),
                State('dropdown-filters', 'value'),
                State('dropdown-enhance', 'value'),
                State('slider-enhancement-factor', 'value'),
-               State('upload-image', 'filename'),
                State('radio-selection-mode', 'value'),
                State('radio-encoding-format', 'value'),
                State('div-storage', 'children'),
                State('session-id', 'children')])
-def update_graph_interactive_image(content,
+def update_graph_interactive_image(upload_handle,
                                    undo_clicks,
+                                   redo_clicks,
                                    n_clicks,
                                    selectedData,
                                    filters,
                                    enhance,
                                    enhancement_factor,
-                                   new_filename,
                                    dragmode,
                                    enc_format,
                                    storage,
                                    session_id):
-    t_start = time.time()
-
     # Retrieve information saved in storage, which is a dict containing
     # information about the image and its action stack
     storage = json.loads(storage)
     filename = storage['filename']  # Filename is the name of the image file.
     image_signature = storage['image_signature']
 
-    # Runs the undo function if the undo button was clicked. Storage stays
-    # the same otherwise.
-    storage = undo_last_action(undo_clicks, storage)
+    # Runs the undo or redo function if the undo or redo button was clicked.
+    # Storage stays the same otherwise.
+    storage = undo_last_action(undo_clicks, storage, session_id)
+    storage = redo_last_action(redo_clicks, storage, session_id)
+
+    # The handle of the last uploaded image, which was already stored by
+    # the upload endpoint
+    upload_handle = json.loads(upload_handle) if upload_handle else None
 
-    # If a new file was uploaded (new file name changed)
-    if new_filename and new_filename != filename:
+    # If a new file was uploaded
+    if upload_handle and \
+            upload_handle['upload_id'] != storage.get('upload_id'):
+        new_filename = upload_handle['filename']
         # Replace filename
-        if DEBUG:
-            print(filename, "replaced by", new_filename)
+        server.logger.info("%s replaced by %s", filename, new_filename)
 
         # Update the storage dict
         storage['filename'] = new_filename
+        storage['image_signature'] = upload_handle['image_signature']
+        storage['upload_id'] = upload_handle['upload_id']
+        storage['size'] = upload_handle['size']
 
-        # Parse the string and convert to pil
-        string = content.split(';base64,')[-1]
-        im_pil = drc.b64_to_pil(string)
-
-        # Update the image signature, which is the first 200 b64 characters
-        # of the string encoding
-        storage['image_signature'] = string[:200]
-
-        # Posts the image string into the Bucketeer Storage (which is hosted
-        # on S3)
-        store_image_string(string, session_id)
-        if DEBUG:
-            print(new_filename, "added to Bucketeer S3.")
-
-        # Resets the action stack
+        # Resets the action and redo stacks
         storage['action_stack'] = []
+        storage['redo_stack'] = []
 
     # If an operation was applied (when the filename wasn't changed)
     else:
+        n_actions = len(storage['action_stack'])
+
+        # Only the run button adds actions, not undo and redo
+        run_clicked = n_clicks is not None and \
+            n_clicks > storage.get('run_click_count', 0)
+        if run_clicked:
+            storage['run_click_count'] = n_clicks
+        else:
+            filters = enhance = None
+
         # Add actions to the action stack (we have more than one if filters
         # and enhance are BOTH selected)
         if filters:
@@ -483,26 +628,44 @@ def update_graph_interactive_image(content,
                 selectedData
             )
 
-        # Apply the required actions to the picture, using memoized function
-        im_pil = apply_actions_on_image(
-            session_id,
-            storage['action_stack'],
-            filename,
-            image_signature
-        )
+        # New actions make the undone ones unreachable
+        n_new_actions = len(storage['action_stack']) - n_actions
+        if n_new_actions > 0:
+            # Apply the new actions to the picture, using the shared states
+            apply_actions_on_image(
+                image_signature,
+                storage['action_stack']
+            )
 
-    t_end = time.time()
-    if DEBUG:
-        print(f"Updated Image Storage in {t_end - t_start:.3f} sec")
+            storage['redo_stack'] = []
+            history.record(
+                session_id,
+                image_signature,
+                storage['action_stack'],
+                n_new_actions
+            )
+
+    # The operations keep the size of the image, so the state itself is only
+    # loaded for the storages saved without the size
+    if not storage.get('size'):
+        storage['size'] = apply_actions_on_image(
+            storage['image_signature'],
+            storage['action_stack']
+        ).size
+
+    # Registers the state, which is then served and encoded through its URL
+    state_key = register_image_state(
+        storage['image_signature'],
+        storage['action_stack']
+    )
 
     return [
-        drc.InteractiveImagePIL(
+        drc.InteractiveImage(
             image_id='interactive-image',
-            image=im_pil,
-            enc_format=enc_format,
+            source=image_state_url(state_key, enc_format),
+            size=storage['size'],
             display_mode='fixed',
-            dragmode=dragmode,
-            verbose=DEBUG
+            dragmode=dragmode
         ),
 
         html.Div(
@@ -513,6 +676,69 @@ def update_graph_interactive_image(content,
     ]
 
 
+def get_default_actions():
+    """
+    Lists the actions obtained by running every filter and enhancement on the
+    whole image, with the default enhancement factor, as they are built by
+    update_graph_interactive_image.
+    """
+    actions = []
+
+    for filter in FILTERS_DICT:
+        actions.append({
+            'operation': filter,
+            'type': 'filter',
+            'selectedData': None
+        })
+
+    for enhancement in ENHANCEMENT_DICT:
+        actions.append({
+            'operation': {
+                'enhancement': enhancement,
+                'enhancement_factor': 1,
+            },
+            'type': 'enhance',
+            'selectedData': None
+        })
+
+    return actions
+
+
+def warm_up_default_image():
+    """
+    Precomputes the states of the default image when the worker starts, so
+    the interactions of new visitors are served from memory: the display
+    encodings and the histogram of the original image, and optionally of the
+    result of every single operation applied on the whole image. They stay in
+    warm_outputs for the lifetime of the worker.
+    """
+    t_start = time.time()
+
+    image_signature = DEFAULT_IMAGE_HANDLE['image_signature']
+    action_stacks = [[]]
+    if PRECOMPUTE_DEFAULT_OPERATIONS:
+        action_stacks += [[action] for action in get_default_actions()]
+
+    for action_stack in action_stacks:
+        state_key = register_image_state(image_signature, action_stack)
+
+        # Only the original is encoded in every format, the operations are
+        # encoded in the default display format
+        enc_formats = DISPLAY_FORMATS if not action_stack else ('jpeg',)
+        for enc_format in enc_formats:
+            warm_outputs[(state_key, enc_format)] = \
+                encode_image_state.uncached(state_key, enc_format)
+        warm_outputs[(state_key, 'histogram')] = \
+            compute_histogram.uncached(state_key)
+
+    t_end = time.time()
+    server.logger.info("Warmed up %d default image states in %.3f sec",
+                       len(action_stacks), t_end - t_start)
+
+
+warm_up_default_image()
+
+
 # Show/Hide Callbacks
 @app.callback(Output('div-enhancement-factor', 'style'),
               [Input('dropdown-enhance', 'value')],
@@ -0,0 +1,75 @@
+// Sends the images dropped or selected inside the upload zone directly to the
+// upload endpoint of the server, instead of reading them as base64 strings
+// inside the browser. The handle returned by the server is then written to a
+// hidden input, which triggers the Dash callbacks.
+(function () {
+    var UPLOAD_ID = 'upload-image';
+    var HANDLE_ID = 'input-upload-handle';
+
+    function insideUpload(element) {
+        var upload = document.getElementById(UPLOAD_ID);
+        return upload !== null && upload.contains(element);
+    }
+
+    // Sets the value of a React controlled input, so that its onChange fires
+    function setHandle(value) {
+        var input = document.getElementById(HANDLE_ID);
+        var setter = Object.getOwnPropertyDescriptor(
+            window.HTMLInputElement.prototype, 'value'
+        ).set;
+
+        setter.call(input, value);
+        input.dispatchEvent(new Event('input', {bubbles: true}));
+    }
+
+    // The endpoint is under the prefix of the requests of the Dash app
+    function uploadUrl() {
+        var config = JSON.parse(
+            document.getElementById('_dash-config').textContent
+        );
+        return config.requests_pathname_prefix + 'upload';
+    }
+
+    function uploadFile(file) {
+        fetch(uploadUrl(), {
+            method: 'POST',
+            body: file,
+            headers: {'X-Filename': encodeURIComponent(file.name)},
+            credentials: 'same-origin'
+        }).then(function (response) {
+            return response.json().then(function (body) {
+                if (!response.ok) {
+                    throw new Error(body.error);
+                }
+                setHandle(JSON.stringify(body));
+            });
+        }).catch(function (error) {
+            window.alert('Upload failed: ' + error.message);
+        });
+    }
+
+    // The listeners are registered in the capture phase on the document, so
+    // they run before the ones of the upload component
+    function onFiles(event, files) {
+        event.preventDefault();
+        event.stopPropagation();
+
+        if (files && files.length > 0) {
+            uploadFile(files[0]);
+        }
+    }
+
+    document.addEventListener('drop', function (event) {
+        if (insideUpload(event.target)) {
+            onFiles(event, event.dataTransfer.files);
+        }
+    }, true);
+
+    document.addEventListener('change', function (event) {
+        if (event.target.type === 'file' && insideUpload(event.target)) {
+            onFiles(event, event.target.files);
+            // Allows selecting the same file again
+            event.target.value = '';
+        }
+    }, true);
+})();
@@ -0,0 +1,271 @@
+"""
+Applies a saved action stack to many images, outside of the Dash app.
+
+The action stack is the edit recipe built by the app: a JSON list of actions
+with their 'operation', 'type' and 'selectedData', or the JSON content of the
+'div-storage' element, which contains it under 'action_stack'.
+
+Usage:
+    python batch.py stack.json images/ photo.jpg -o output/ --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from PIL import Image
+
+from utils import apply_action
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff',
+                    '.webp')
+
+# Modes on which all the filters and enhancements work, the images of the
+# other modes (e.g. palette images) are converted when they are opened
+SUPPORTED_MODES = ('L', 'RGB', 'RGBA')
+
+
+def load_action_stack(path):
+    """
+    Loads an action stack saved as JSON, either as a list of actions or as
+    the storage of the app.
+    """
+    with open(path) as f:
+        content = json.load(f)
+
+    if isinstance(content, dict):
+        return content['action_stack']
+
+    return content
+
+
+def list_images(inputs):
+    """
+    Lists the image files given directly, or contained in the given
+    directories (not recursively), sorted by name.
+    """
+    paths = []
+
+    for path in inputs:
+        if os.path.isdir(path):
+            paths += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            paths.append(path)
+
+    return paths
+
+
+def open_image(input_path):
+    """
+    Opens an image file, converting it to RGB, or to RGBA if it has
+    transparency, when its mode is not supported by the operations.
+    :return: The PIL image
+    """
+    image = Image.open(input_path)
+    if image.mode in SUPPORTED_MODES:
+        return image
+
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+    with image:
+        return image.convert('RGBA' if has_alpha else 'RGB')
+
+
+def apply_action_stack(image, action_stack):
+    """
+    Applies all the actions of the stack on a copy of the image.
+    :return: The edited PIL image
+    """
+    image = image.copy()
+
+    for action in action_stack:
+        apply_action(image, action)
+
+    return image
+
+
+def get_output_path(input_path, output_dir, enc_format=None):
+    name = os.path.basename(input_path)
+
+    if enc_format:
+        name = os.path.splitext(name)[0] + '.' + enc_format
+
+    return os.path.join(output_dir, name)
+
+
+def check_output_paths(paths, output_dir, enc_format=None):
+    """
+    Checks that no output file would overwrite an input file or another
+    output file.
+    :raise ValueError: If the output directory contains some of the inputs,
+    or if several inputs have the same output name
+    """
+    output_dir = os.path.realpath(output_dir)
+
+    overwritten = [path for path in paths
+                   if os.path.dirname(os.path.realpath(path)) == output_dir]
+    if overwritten:
+        raise ValueError(f"The output directory contains the input images, "
+                         f"e.g. {overwritten[0]}")
+
+    names = Counter(
+        os.path.normcase(get_output_path(path, output_dir, enc_format))
+        for path in paths
+    )
+    duplicates = sorted(name for name, count in names.items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Several input images would be written to "
+                         f"{', '.join(duplicates)}")
+
+
+def process_image(input_path, action_stack, output_dir, enc_format=None):
+    """
+    Applies the action stack on an image file and writes the result to the
+    output directory. It runs inside the worker processes, and only returns
+    a summary so the images never travel back to the main process.
+    :return: The input path, the output path, the number of pixels and the
+    processing time in seconds
+    """
+    t_start = time.time()
+
+    output_path = get_output_path(input_path, output_dir, enc_format)
+
+    with open_image(input_path) as image:
+        edited = apply_action_stack(image, action_stack)
+
+    if edited.mode == 'RGBA' and \
+            output_path.lower().endswith(('.jpg', '.jpeg')):
+        edited = edited.convert('RGB')
+
+    edited.save(output_path)
+
+    return input_path, output_path, edited.size[0] * edited.size[1], \
+        time.time() - t_start
+
+
+def run_batch(paths,
+              action_stack,
+              output_dir,
+              workers=None,
+              max_pending=None,
+              enc_format=None):
+    """
+    Applies the action stack on every image with a process pool, and yields
+    the result of each image as soon as it is written: its path, its summary
+    and None, or its path, None and the exception if it failed. A failed
+    image does not stop the others. At most max_pending images are submitted
+    at once, which bounds the memory used by the batch to about that many
+    decoded images.
+    :param paths: The paths of the image files, checked by check_output_paths
+    :param workers: The number of processes, by default the number of CPUs
+    :param max_pending: The maximum number of images being processed or
+    waiting for a process, by default twice the number of workers
+    :param enc_format: The extension of the output files, by default the one
+    of the input files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+
+    paths = iter(paths)
+    # Maps the futures to the paths of their images
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Keep the queue filled up to max_pending images
+            for path in paths:
+                future = executor.submit(
+                    process_image, path, action_stack, output_dir, enc_format)
+                pending[future] = path
+
+                if len(pending) >= max_pending:
+                    break
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    yield path, None, e
+                else:
+                    yield path, summary, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Applies a saved action stack to many images.")
+    parser.add_argument('action_stack',
+                        help="JSON file of the action stack")
+    parser.add_argument('inputs', nargs='+',
+                        help="Image files, or directories containing them")
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help="Directory in which the edited images are written")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="Number of processes (default: number of CPUs)")
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help="Maximum number of images in memory at once "
+                             "(default: twice the number of workers)")
+    parser.add_argument('--format', dest='enc_format', default=None,
+                        help="Extension of the output files, e.g. png "
+                             "(default: same as the inputs)")
+    args = parser.parse_args(argv)
+
+    action_stack = load_action_stack(args.action_stack)
+    paths = list_images(args.inputs)
+
+    try:
+        check_output_paths(paths, args.output_dir, args.enc_format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    t_start = time.time()
+    n_images = n_pixels = 0
+    failures = []
+
+    for input_path, summary, error in run_batch(
+            paths,
+            action_stack,
+            args.output_dir,
+            workers=args.workers,
+            max_pending=args.max_pending,
+            enc_format=args.enc_format):
+        index = n_images + len(failures) + 1
+
+        if error is not None:
+            failures.append(input_path)
+            print(f"[{index}/{len(paths)}] {input_path} failed: "
+                  f"{type(error).__name__}: {error}", file=sys.stderr)
+            continue
+
+        _, output_path, pixels, duration = summary
+        n_images += 1
+        n_pixels += pixels
+        print(f"[{index}/{len(paths)}] {input_path} -> {output_path} "
+              f"in {duration:.3f} sec")
+
+    t_total = time.time() - t_start
+    if n_images:
+        print(f"Processed {n_images} images ({n_pixels / 1e6:.1f} MP) in "
+              f"{t_total:.3f} sec: {n_images / t_total:.2f} images/sec, "
+              f"{n_pixels / 1e6 / t_total:.2f} MP/sec")
+    elif not failures:
+        print("No image to process.")
+
+    if failures:
+        print(f"{len(failures)} images failed.", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+"""
+Benchmarks the stages of the image pipeline on synthetic images, and writes
+the timings as JSON so that two runs can be compared.
+
+The images are generated, and the original images are stored inside a
+temporary LocalStorage, so it runs offline and without the app.
+
+Usage:
+    python benchmark.py --sizes 1 12 50 --output results.json
+    python benchmark.py --compare results.json --output new_results.json
+"""
+import argparse
+import json
+import math
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import PIL
+from PIL import Image
+from werkzeug.contrib.cache import SimpleCache
+
+import dash_reusable_components as drc
+import utils
+from state_store import SharedStateStore
+from storage import LocalStorage
+from upload import content_hash
+from utils import apply_filters, apply_enhancements, generate_lasso_mask, \
+    get_selection_zone, show_histogram
+
+# Sizes of the synthetic images, in megapixels
+DEFAULT_SIZES = (1, 5, 12, 25, 50)
+
+# Depths of the action stacks replayed by apply_actions_on_image
+DEFAULT_DEPTHS = (1, 4, 8, 16)
+
+DEFAULT_REPEAT = 3
+
+# Number of points of the synthetic lasso paths
+LASSO_POINTS = 500
+
+# Relative slowdown above which a case is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def synthetic_image(megapixels, seed=0):
+    """
+    Generates a deterministic 4:3 RGB image made of gradients and noise, so
+    that it compresses about as well as a photo.
+    """
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+
+    random = np.random.RandomState(seed)
+    # The gradients leave room for the noise, so that it does not overflow
+    x = np.linspace(0, 239, width, dtype=np.float32)
+    y = np.linspace(0, 239, height, dtype=np.float32)[:, None]
+
+    array = np.empty((height, width, 3), dtype=np.uint8)
+    array[..., 0] = x
+    array[..., 1] = y
+    array[..., 2] = (x + y) / 2
+    array += random.randint(0, 16, size=(height, width, 3), dtype=np.uint8)
+
+    return Image.fromarray(array, 'RGB')
+
+
+def select_data(image):
+    """
+    :return: The selectedData of a rectangle covering the center of the image
+    """
+    width, height = image.size
+
+    return {'range': {
+        'x': [width / 4, 3 * width / 4],
+        'y': [height / 4, 3 * height / 4]
+    }}
+
+
+def lasso_data(image, n_points=LASSO_POINTS):
+    """
+    :return: The selectedData of a wavy lasso path around the center of the
+    image
+    """
+    width, height = image.size
+    angles = np.linspace(0, 2 * np.pi, n_points)
+    radius = 0.3 + 0.05 * np.sin(7 * angles)
+
+    return {'lassoPoints': {
+        'x': list(width / 2 + radius * width * np.cos(angles)),
+        'y': list(height / 2 + radius * height * np.sin(angles))
+    }}
+
+
+def action_stack(image, depth):
+    """
+    :return: An action stack of the given depth, alternating filters and
+    enhancements over the whole image, a rectangle and a lasso
+    """
+    selections = [None, select_data(image), lasso_data(image)]
+    actions = []
+
+    for i in range(depth):
+        if i % 2 == 0:
+            actions.append({
+                'operation': 'blur',
+                'type': 'filter',
+                'selectedData': selections[i % 3]
+            })
+        else:
+            actions.append({
+                'operation': {
+                    'enhancement': 'contrast',
+                    'enhancement_factor': 1.2
+                },
+                'type': 'enhance',
+                'selectedData': selections[i % 3]
+            })
+
+    return actions
+
+
+def measure(func, setup=None, repeat=DEFAULT_REPEAT):
+    """
+    Times the function repeat times. The setup function, whose result is
+    passed to the function, is not timed.
+    :return: The statistics of the timings, in seconds
+    """
+    timings = []
+
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+
+        t_start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - t_start)
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'repeat': repeat
+    }
+
+
+def benchmark_encoding(image, repeat):
+    results = {}
+
+    for enc_format in ('png', 'jpeg'):
+        string = drc.pil_to_b64(image, enc_format)
+
+        results[f'pil_to_b64[{enc_format}]'] = measure(
+            lambda: drc.pil_to_b64(image, enc_format), repeat=repeat)
+
+        # The images are decoded lazily, so the pixels are loaded explicitly
+        results[f'b64_to_pil[{enc_format}]'] = measure(
+            lambda: drc.b64_to_pil(string).load(), repeat=repeat)
+
+    return results
+
+
+def benchmark_operations(image, repeat):
+    results = {}
+
+    for mode, selected_data in (('select', select_data(image)),
+                                ('lasso', lasso_data(image))):
+        _, zone = get_selection_zone(image, selected_data)
+
+        # The operations are applied in-place, on a fresh copy every time
+        results[f'apply_filters[{mode}]'] = measure(
+            lambda im: apply_filters(im, zone, 'blur', mode),
+            setup=lambda: (image.copy(),),
+            repeat=repeat)
+
+        results[f'apply_enhancements[{mode}]'] = measure(
+            lambda im: apply_enhancements(im, zone, 'contrast', 1.2, mode),
+            setup=lambda: (image.copy(),),
+            repeat=repeat)
+
+    selected_data = lasso_data(image)
+
+    results['generate_lasso_mask'] = measure(
+        lambda: generate_lasso_mask(image, selected_data),
+        setup=lambda: utils.clear_lasso_masks() or (),
+        repeat=repeat)
+
+    results['generate_lasso_mask[cached]'] = measure(
+        lambda: generate_lasso_mask(image, selected_data),
+        repeat=repeat)
+
+    results['show_histogram'] = measure(
+        lambda: show_histogram(image), repeat=repeat)
+
+    return results
+
+
+def benchmark_replays(image, depths, repeat):
+    """
+    Times the retrieval of the state of action stacks by the state store, as
+    done by apply_actions_on_image when none of the states are cached yet. It
+    includes fetching and decoding the original image from the storage.
+    """
+    results = {}
+
+    buffer = BytesIO()
+    image.save(buffer, format='jpeg', quality=95)
+    data = buffer.getvalue()
+    image_signature = content_hash(data).hexdigest()
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LocalStorage(directory)
+        storage.put(image_signature, BytesIO(data))
+
+        def load_original(image_signature):
+            im = drc.bytes_to_pil(storage.get(image_signature))
+            im.load()
+            return im
+
+        for depth in depths:
+            actions = action_stack(image, depth)
+
+            def setup():
+                utils.clear_lasso_masks()
+                state_store = SharedStateStore(
+                    SimpleCache(threshold=10 ** 6), load_original)
+                return (state_store,)
+
+            results[f'apply_actions_on_image[depth={depth}]'] = measure(
+                lambda state_store: state_store.get_image(
+                    image_signature, actions),
+                setup=setup,
+                repeat=repeat)
+
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES,
+                   depths=DEFAULT_DEPTHS,
+                   repeat=DEFAULT_REPEAT,
+                   verbose=True):
+    """
+    Runs all the benchmarks on a synthetic image of each size.
+    :return: The dict of the results, with the timings of each case keyed by
+    its name and the image size
+    """
+    results = {
+        'metadata': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pillow': PIL.__version__,
+            'numpy': np.__version__,
+            'repeat': repeat
+        },
+        'cases': {}
+    }
+
+    for megapixels in sizes:
+        image = synthetic_image(megapixels)
+
+        for group in (benchmark_encoding(image, repeat),
+                      benchmark_operations(image, repeat),
+                      benchmark_replays(image, depths, repeat)):
+            for name, timings in group.items():
+                case = f'{name}@{megapixels:g}MP'
+                timings['size'] = image.size
+                results['cases'][case] = timings
+
+                if verbose:
+                    print(f"{case:<50} {timings['median'] * 1000:>10.1f} ms")
+
+    return results
+
+
+def compare_results(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the median timings of two runs.
+    :return: The list of the (case, baseline median, new median, ratio) of the
+    cases found in both runs, and the list of the regressed cases
+    """
+    comparison = []
+    regressions = []
+
+    for case, timings in results['cases'].items():
+        if case not in baseline['cases']:
+            continue
+
+        old_median = baseline['cases'][case]['median']
+        new_median = timings['median']
+        ratio = new_median / old_median if old_median else float('inf')
+
+        comparison.append((case, old_median, new_median, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(case)
+
+    return comparison, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the image pipeline on synthetic images.")
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help="Sizes of the images, in megapixels")
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=DEFAULT_DEPTHS,
+                        help="Depths of the replayed action stacks")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="Number of runs of each case")
+    parser.add_argument('--output', default=None,
+                        help="JSON file in which the results are written")
+    parser.add_argument('--compare', default=None,
+                        help="JSON file of previous results to compare with")
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help="Relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.depths, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        comparison, regressions = compare_results(
+            baseline, results, args.threshold)
+
+        print()
+        for case, old_median, new_median, ratio in comparison:
+            flag = ' REGRESSION' if case in regressions else ''
+            print(f"{case:<50} {old_median * 1000:>10.1f} ms -> "
+                  f"{new_median * 1000:>10.1f} ms ({ratio:.2f}x){flag}")
+
+        # Fail when a case regressed, e.g. inside a CI job
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
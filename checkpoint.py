@@ -0,0 +1,78 @@
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# zlib compression level of the patches. The lowest levels are the fastest,
+# and already remove most of the redundancy of the pixels.
+COMPRESSION_LEVEL = 1
+
+
+def get_changed_box(before, after):
+    """
+    Computes the bounding box of the pixels that differ between two images of
+    the same mode and size.
+    :return: The (left, upper, right, lower) box, or None if they are equal
+    """
+    before_array = np.asarray(before)
+    after_array = np.asarray(after)
+
+    changed = before_array != after_array
+    # Merge the bands of multi-band images
+    if changed.ndim == 3:
+        changed = changed.any(axis=2)
+
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+
+    return (int(columns[0]), int(rows[0]),
+            int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+
+def compress_region(image, box):
+    return zlib.compress(image.crop(box).tobytes(), COMPRESSION_LEVEL)
+
+
+def create_checkpoint(before, after):
+    """
+    Creates the checkpoint of a step going from the image before to the image
+    after. It only contains the bounding box of the changed pixels, and the
+    compressed raw bytes of that region before and after the step, so its size
+    is roughly proportional to the modified region.
+    """
+    box = get_changed_box(before, after)
+
+    checkpoint = {
+        'mode': after.mode,
+        'box': box,
+        'before': None,
+        'after': None,
+        'bytes': 0
+    }
+
+    if box is not None:
+        checkpoint['before'] = compress_region(before, box)
+        checkpoint['after'] = compress_region(after, box)
+        checkpoint['bytes'] = \
+            len(checkpoint['before']) + len(checkpoint['after'])
+
+    return checkpoint
+
+
+def apply_checkpoint(image, checkpoint, direction='after'):
+    """
+    Applies a checkpoint on the image in-place, either forward to redo its
+    step ('after'), or backward to undo it ('before'). The reconstruction is
+    bit-exact.
+    """
+    box = checkpoint['box']
+    if box is None:
+        return
+
+    size = (box[2] - box[0], box[3] - box[1])
+    data = zlib.decompress(checkpoint[direction])
+    region = Image.frombytes(checkpoint['mode'], size, data)
+
+    image.paste(region, box)
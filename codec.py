@@ -0,0 +1,72 @@
+import struct
+import zlib
+
+from PIL import Image
+
+# Marks the values encoded by this codec
+MAGIC = b'DIPIMG1'
+
+# Header following the magic: compression flag, width, height, mode length
+HEADER = struct.Struct('>BIIB')
+
+RAW = 0
+ZLIB = 1
+
+# Images with a palette are not encoded, since the palette would be lost
+UNSUPPORTED_MODES = ('P', 'PA')
+
+
+def can_encode(value):
+    return isinstance(value, Image.Image) and \
+        value.mode not in UNSUPPORTED_MODES
+
+
+def encode_image(image, compress=False, level=1):
+    """
+    Encodes a PIL Image into a compact binary value: a small header with its
+    mode and size, followed by its raw pixel bytes, optionally compressed
+    with zlib. It is much cheaper to produce and to read than a pickle.
+    :param compress: Whether the pixel bytes are compressed
+    :param level: The zlib compression level, the lowest levels are the fastest
+    :return: The encoded bytes
+    """
+    mode = image.mode.encode('ascii')
+    data = image.tobytes()
+
+    if compress:
+        data = zlib.compress(data, level)
+
+    header = HEADER.pack(ZLIB if compress else RAW, *image.size, len(mode))
+
+    return b''.join([MAGIC, header, mode, data])
+
+
+def is_encoded_image(value):
+    return isinstance(value, (bytes, bytearray, memoryview)) and \
+        bytes(value[:len(MAGIC)]) == MAGIC
+
+
+def decode_image(value):
+    """
+    Decodes a value created by encode_image. For the modes whose memory layout
+    matches the raw bytes (e.g. L, RGBA or CMYK), the uncompressed pixel data
+    is not copied, and the image stays read-only until it is modified (PIL
+    then copies it). The other modes, like RGB, are copied.
+    :param value: The encoded bytes, or any buffer such as a memory map
+    :return: PIL Image object
+    """
+    view = memoryview(value)
+    offset = len(MAGIC)
+
+    compression, width, height, mode_length = \
+        HEADER.unpack_from(view, offset)
+    offset += HEADER.size
+
+    mode = bytes(view[offset:offset + mode_length]).decode('ascii')
+    offset += mode_length
+
+    data = view[offset:]
+    if compression == ZLIB:
+        data = zlib.decompress(data)
+
+    return Image.frombuffer(mode, (width, height), data, 'raw', mode, 0, 1)
@@ -9,6 +9,8 @@ import numpy as np
 import plotly.graph_objs as go
 from PIL import Image
 
+import metrics
+
 
 # Variables
 HTML_IMG_SRC_PARAMETERS = 'data:image/png;base64, '
@@ -33,9 +35,7 @@ def pil_to_b64(im, enc_format='png', verbose=False, **kwargs):
     """
     t_start = time.time()
 
-    buff = _BytesIO()
-    im.save(buff, format=enc_format, **kwargs)
-    encoded = base64.b64encode(buff.getvalue()).decode("utf-8")
+    encoded = base64.b64encode(pil_to_bytes(im, enc_format, **kwargs)).decode("utf-8")
 
     t_end = time.time()
     if verbose:
@@ -44,6 +44,35 @@ def pil_to_b64(im, enc_format='png', verbose=False, **kwargs):
     return encoded
 
 
+def pil_to_bytes(im, enc_format='png', **kwargs):
+    """
+    Converts a PIL Image into the raw bytes of the given image format, e.g. for serving it over HTTP
+    :param im: PIL Image object
+    :param enc_format: The image format for encoding.
+    :return: the encoded bytes
+    """
+    buff = _BytesIO()
+    with metrics.timed('encode', format=enc_format):
+        im.save(buff, format=enc_format, **kwargs)
+
+    return buff.getvalue()
+
+
+def pil_to_display_bytes(im, enc_format='png'):
+    """
+    Encodes a PIL Image with the settings used for displaying it inside the interactive image
+    :param im: PIL Image object
+    :param enc_format: The display format, either 'jpeg' or 'png'
+    :return: the encoded bytes
+    """
+    if enc_format == 'jpeg':
+        if im.mode == 'RGBA':
+            im = im.convert('RGB')
+        return pil_to_bytes(im, enc_format=enc_format, quality=80)
+
+    return pil_to_bytes(im, enc_format=enc_format)
+
+
 def numpy_to_b64(np_array, enc_format='png', scalar=True, **kwargs):
     """
     Converts a numpy image into base 64 string for HTML displaying
@@ -65,7 +94,17 @@ def numpy_to_b64(np_array, enc_format='png', scalar=True, **kwargs):
 
 def b64_to_pil(string):
     decoded = base64.b64decode(string)
-    buffer = _BytesIO(decoded)
+
+    return bytes_to_pil(decoded)
+
+
+def bytes_to_pil(data):
+    """
+    Opens a PIL Image from the bytes of an encoded image file
+    :param data: The bytes of the image file, e.g. in the jpeg or png format
+    :return: PIL Image object
+    """
+    buffer = _BytesIO(data)
     im = Image.open(buffer)
 
     return im
@@ -234,7 +273,30 @@ def InteractiveImagePIL(image_id,
     else:
         encoded_image = pil_to_b64(image, enc_format=enc_format, verbose=verbose)
 
-    width, height = image.size
+    return InteractiveImage(
+        image_id=image_id,
+        source=HTML_IMG_SRC_PARAMETERS + encoded_image,
+        size=image.size,
+        display_mode=display_mode,
+        dragmode=dragmode,
+        **kwargs
+    )
+
+
+def InteractiveImage(image_id,
+                     source,
+                     size,
+                     display_mode='fixed',
+                     dragmode='select',
+                     **kwargs):
+    """
+    Interactive image graph whose image is loaded from the given source, which can either be
+    a base64 data URI or a URL. Using a URL keeps the figure light, so updating its layout does
+    not send the image back and forth.
+    :param source: The source of the layout image
+    :param size: The (width, height) of the image
+    """
+    width, height = size
 
     if display_mode.lower() in ['scalable', 'scale']:
         display_height = '{}vw'.format(round(60 * height / width))
@@ -265,7 +327,7 @@ def InteractiveImagePIL(image_id,
                     'sizex': width,
                     'sizey': height,
                     'layer': 'below',
-                    'source': HTML_IMG_SRC_PARAMETERS + encoded_image,
+                    'source': source,
                 }],
                 'dragmode': dragmode,
             }
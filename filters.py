@@ -0,0 +1,234 @@
+"""
+Registry of the filters that can be applied on the images.
+
+Each filter declares its support radius: the distance up to which the
+neighbours of a pixel affect its filtered value. A region of an image is then
+filtered on its own, with a margin of that radius around it, and gives the
+same pixels as filtering the whole image.
+
+Besides the fixed 3x3 and 5x5 kernels of PIL, filters can be defined as
+vectorized NumPy or scipy.ndimage functions on the pixel array, with the
+register_array_filter decorator. The arrays are filtered in tiles, each with
+the margin of the radius, which bounds the size of the temporary arrays of
+the functions on large images.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageFilter
+from scipy import ndimage
+
+# Maps the filter names to the Filter objects, in the order of the dropdown
+FILTERS_DICT = OrderedDict()
+
+# Gaussian kernels are truncated at TRUNCATE standard deviations
+TRUNCATE = 3.0
+
+GAUSSIAN_BLUR_SIGMA = 4
+UNSHARP_MASK_SIGMA = 2
+UNSHARP_MASK_AMOUNT = 1.0
+MEDIAN_RADIUS = 2
+BILATERAL_SIGMA_SPATIAL = 2
+BILATERAL_SIGMA_RANGE = 30
+
+# Size, in pixels, of the tiles in which the array filters are applied
+TILE_SIZE = 256
+
+
+class Filter:
+    """
+    A filter of the registry.
+    :param label: The name displayed in the dropdown
+    :param radius: The support radius of the filter, in pixels
+    :param function: Function returning the filtered copy of a PIL image
+    """
+
+    def __init__(self, label, radius, function):
+        self.label = label
+        self.radius = radius
+        self.function = function
+
+    def __call__(self, image):
+        return self.function(image)
+
+
+def gaussian_radius(sigma):
+    # Radius of the kernels of scipy.ndimage.gaussian_filter
+    return int(TRUNCATE * sigma + 0.5)
+
+
+def register_pil_filter(name, label, image_filter):
+    """
+    Registers a built-in kernel of PIL.ImageFilter, whose radius is given by
+    the size of its kernel.
+    """
+    radius = image_filter.filterargs[0][0] // 2
+
+    FILTERS_DICT[name] = Filter(
+        label, radius, lambda image: image.filter(image_filter))
+
+
+def register_array_filter(name, label, radius):
+    """
+    Decorator registering a filter defined on the pixel array. The function
+    receives a float32 array of shape (height, width, bands), and returns
+    the filtered array of the same shape. Only the images with 8-bit bands
+    can be filtered this way.
+
+    The function is called on tiles of at most TILE_SIZE pixels, each with a
+    margin of the radius, so it must not depend on the pixels further away.
+    """
+    def decorator(function):
+        def apply(image):
+            # The palette images hold indices rather than colors
+            array = np.asarray(image)
+            if image.mode in ('P', 'PA') or array.dtype != np.uint8:
+                raise ValueError(f"The {label} filter does not support the "
+                                 f"{image.mode} mode")
+
+            single_band = array.ndim == 2
+            if single_band:
+                array = array[..., np.newaxis]
+
+            height, width = array.shape[:2]
+            result = np.empty_like(array)
+
+            for top in range(0, height, TILE_SIZE):
+                for left in range(0, width, TILE_SIZE):
+                    bottom = min(top + TILE_SIZE, height)
+                    right = min(left + TILE_SIZE, width)
+                    upper, lower = max(top - radius, 0), \
+                        min(bottom + radius, height)
+                    start, end = max(left - radius, 0), \
+                        min(right + radius, width)
+
+                    filtered = function(
+                        array[upper:lower, start:end].astype(np.float32))
+
+                    result[top:bottom, left:right] = np.clip(np.rint(
+                        filtered[top - upper:bottom - upper,
+                                 left - start:right - start]), 0, 255)
+
+            if single_band:
+                result = result[..., 0]
+
+            return Image.fromarray(result, image.mode)
+
+        FILTERS_DICT[name] = Filter(label, radius, apply)
+        return function
+
+    return decorator
+
+
+def filter_region(image, box, filter):
+    """
+    Filters a region of the image, with a margin of the radius of the filter
+    around it, so the kernel sees the same neighbours as on the whole image.
+    :param box: The (left, upper, right, lower) box of the region
+    :param filter: The Filter object
+    :return: The filtered region, of the size of the box, or None if the box
+    is outside the image
+    """
+    width, height = image.size
+    radius = filter.radius
+
+    left, upper = max(box[0] - radius, 0), max(box[1] - radius, 0)
+    right, lower = min(box[2] + radius, width), min(box[3] + radius, height)
+    if left >= right or upper >= lower:
+        return None
+
+    filtered = filter(image.crop((left, upper, right, lower)))
+
+    return filtered.crop((box[0] - left, box[1] - upper,
+                          box[2] - left, box[3] - upper))
+
+
+register_pil_filter('blur', 'Blur', ImageFilter.BLUR)
+register_pil_filter('contour', 'Contour', ImageFilter.CONTOUR)
+register_pil_filter('detail', 'Detail', ImageFilter.DETAIL)
+register_pil_filter('edge_enhance', 'Enhance Edge', ImageFilter.EDGE_ENHANCE)
+register_pil_filter('edge_enhance_more', 'Enhance Edge (More)',
+                    ImageFilter.EDGE_ENHANCE_MORE)
+register_pil_filter('emboss', 'Emboss', ImageFilter.EMBOSS)
+register_pil_filter('find_edges', 'Find Edges', ImageFilter.FIND_EDGES)
+register_pil_filter('sharpen', 'Sharpen', ImageFilter.SHARPEN)
+register_pil_filter('smooth', 'Smooth', ImageFilter.SMOOTH)
+register_pil_filter('smooth_more', 'Smooth (More)', ImageFilter.SMOOTH_MORE)
+
+
+@register_array_filter('gaussian_blur', 'Gaussian Blur',
+                       radius=gaussian_radius(GAUSSIAN_BLUR_SIGMA))
+def gaussian_blur(array, sigma=GAUSSIAN_BLUR_SIGMA):
+    # The bands are not blurred together
+    return ndimage.gaussian_filter(
+        array, sigma=(sigma, sigma, 0), mode='nearest', truncate=TRUNCATE)
+
+
+@register_array_filter('unsharp_mask', 'Unsharp Mask',
+                       radius=gaussian_radius(UNSHARP_MASK_SIGMA))
+def unsharp_mask(array,
+                 sigma=UNSHARP_MASK_SIGMA,
+                 amount=UNSHARP_MASK_AMOUNT):
+    blurred = gaussian_blur(array, sigma)
+
+    return array + amount * (array - blurred)
+
+
+@register_array_filter('median', 'Median', radius=MEDIAN_RADIUS)
+def median(array, radius=MEDIAN_RADIUS):
+    size = 2 * radius + 1
+
+    return ndimage.median_filter(array, size=(size, size, 1), mode='nearest')
+
+
+@register_array_filter('bilateral', 'Bilateral',
+                       radius=2 * BILATERAL_SIGMA_SPATIAL)
+def bilateral(array,
+              sigma_spatial=BILATERAL_SIGMA_SPATIAL,
+              sigma_range=BILATERAL_SIGMA_RANGE):
+    """
+    Edge-preserving smoothing: each pixel is averaged with its neighbours,
+    weighted by their distance and by their difference of color. The image is
+    processed one neighbour offset at a time, with whole-array operations on
+    each band separately: summing over the last, tiny axis of the array is
+    much slower than adding the planes of the bands. The temporary arrays are
+    reused across the offsets.
+    """
+    radius = 2 * sigma_spatial
+    height, width, bands = array.shape
+    planes = np.pad(array, ((radius, radius), (radius, radius), (0, 0)),
+                    mode='edge').transpose(2, 0, 1).copy()
+    center = planes[:, radius:radius + height, radius:radius + width]
+
+    total = np.zeros((bands, height, width), dtype=np.float32)
+    weights = np.zeros((height, width), dtype=np.float32)
+    weight = np.empty((height, width), dtype=np.float32)
+    buffer = np.empty((height, width), dtype=np.float32)
+
+    range_scale = np.float32(-1 / (2 * sigma_range ** 2))
+
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            neighbour = planes[:, radius + dy:radius + dy + height,
+                               radius + dx:radius + dx + width]
+
+            # Squared distance of the colors
+            weight.fill(0)
+            for band in range(bands):
+                np.subtract(neighbour[band], center[band], out=buffer)
+                np.square(buffer, out=buffer)
+                weight += buffer
+
+            weight *= range_scale
+            weight += np.float32(
+                -(dx * dx + dy * dy) / (2 * sigma_spatial ** 2))
+            np.exp(weight, out=weight)
+            weights += weight
+
+            for band in range(bands):
+                np.multiply(neighbour[band], weight, out=buffer)
+                total[band] += buffer
+
+    total /= weights
+
+    return total.transpose(1, 2, 0)
@@ -0,0 +1,174 @@
+import os
+import threading
+from collections import OrderedDict
+
+from checkpoint import create_checkpoint, apply_checkpoint
+from state_store import get_prefix_keys
+
+# Maximum size in bytes of the patches kept in memory for each session. The
+# oldest patches are spilled to the cache backend beyond that size.
+HISTORY_MAX_BYTES = int(os.environ.get('HISTORY_MAX_BYTES', 32 * 1024 ** 2))
+
+# Maximum number of sessions whose patches are kept in memory by a worker
+HISTORY_MAX_SESSIONS = int(os.environ.get('HISTORY_MAX_SESSIONS', 64))
+
+# Maximum size in bytes of the patches kept in memory by a worker, for all
+# its sessions. The least recently used sessions are spilled beyond that size.
+HISTORY_MAX_TOTAL_BYTES = int(
+    os.environ.get('HISTORY_MAX_TOTAL_BYTES', 256 * 1024 ** 2))
+
+
+class SessionHistory:
+    """
+    Retains, for each session, a checkpoint of the region modified by each
+    step of its action stack. Undoing or redoing a step then costs a single
+    paste of the patch on the current state, instead of a replay of the whole
+    stack.
+
+    The patches are kept in memory up to HISTORY_MAX_BYTES per session and
+    HISTORY_MAX_TOTAL_BYTES per worker, the oldest ones being spilled to the
+    cache backend, which is also where the other workers find them.
+    """
+
+    def __init__(self,
+                 cache,
+                 state_store,
+                 max_bytes=HISTORY_MAX_BYTES,
+                 max_sessions=HISTORY_MAX_SESSIONS,
+                 max_total_bytes=HISTORY_MAX_TOTAL_BYTES,
+                 timeout=None):
+        self.cache = cache
+        self.state_store = state_store
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.max_total_bytes = max_total_bytes
+        self.timeout = timeout
+
+        # session_id -> OrderedDict of the patches, from oldest to newest.
+        # They are shared by the threads of the worker.
+        self._sessions = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def _cache_key(self, session_id, step_key):
+        return f'history-{session_id}-{step_key}'
+
+    def _spill(self, session_id, step_key, patch):
+        self.cache.set(self._cache_key(session_id, step_key), patch,
+                       timeout=self.timeout)
+
+    def _pop_session(self, spilled):
+        # Removes the least recently used session, adding its patches to the
+        # list of those to spill
+        old_session_id, old_patches = self._sessions.popitem(last=False)
+        del self._sizes[old_session_id]
+
+        for old_step_key, old_patch in old_patches.items():
+            spilled.append((old_session_id, old_step_key, old_patch))
+
+    def _add_patch(self, session_id, step_key, patch):
+        # The patches are removed from memory under the lock, and spilled to
+        # the cache backend once it is released
+        spilled = []
+
+        with self._lock:
+            if session_id not in self._sessions:
+                self._sessions[session_id] = OrderedDict()
+                self._sizes[session_id] = 0
+
+                # Spill the least recently used session when there are too
+                # many
+                if len(self._sessions) > self.max_sessions:
+                    self._pop_session(spilled)
+
+            self._sessions.move_to_end(session_id)
+            patches = self._sessions[session_id]
+            patches[step_key] = patch
+            self._sizes[session_id] += patch['bytes']
+
+            # Spill the oldest patches beyond the memory budget of the session
+            while self._sizes[session_id] > self.max_bytes and \
+                    len(patches) > 1:
+                old_step_key, old_patch = patches.popitem(last=False)
+                self._sizes[session_id] -= old_patch['bytes']
+                spilled.append((session_id, old_step_key, old_patch))
+
+            # Spill the least recently used sessions beyond the memory budget
+            # of the worker, keeping at least the current one
+            while sum(self._sizes.values()) > self.max_total_bytes and \
+                    len(self._sessions) > 1:
+                self._pop_session(spilled)
+
+        for old_session_id, old_step_key, old_patch in spilled:
+            self._spill(old_session_id, old_step_key, old_patch)
+
+    def _get_patch(self, session_id, step_key):
+        with self._lock:
+            patch = self._sessions.get(session_id, {}).get(step_key)
+
+        if patch is not None:
+            return patch
+
+        return self.cache.get(self._cache_key(session_id, step_key))
+
+    def record(self, session_id, image_signature, action_stack, n_steps):
+        """
+        Records the patches of the last steps of the action stack, which were
+        just applied.
+        :param n_steps: The number of new actions at the end of the stack
+        """
+        keys = get_prefix_keys(image_signature, action_stack)
+
+        for i in range(len(action_stack) - n_steps, len(action_stack)):
+            # Reuse the checkpoint cached by the state store when possible
+            patch = self.state_store.get_checkpoint(keys[i + 1])
+
+            if patch is None:
+                before = self.state_store.get_image(
+                    image_signature, action_stack[:i])
+                after = self.state_store.get_image(
+                    image_signature, action_stack[:i + 1])
+                patch = create_checkpoint(before, after)
+
+            self._add_patch(session_id, keys[i + 1], patch)
+
+    def _restore(self, session_id, image_signature, action_stack, direction):
+        # The step goes from the state of the stack without its last action
+        # (the parent) to the state of the full stack (the child)
+        keys = get_prefix_keys(image_signature, action_stack)
+        parent_key, child_key = keys[-2], keys[-1]
+
+        if direction == 'before':
+            source_key, target_key = child_key, parent_key
+        else:
+            source_key, target_key = parent_key, child_key
+
+        # Nothing to do when the target state is still cached
+        if self.state_store.has(target_key):
+            return
+
+        patch = self._get_patch(session_id, child_key)
+        source = self.state_store.get_cached(source_key)
+
+        # Otherwise, the target state is replayed when it is retrieved
+        if patch is None or source is None:
+            return
+
+        apply_checkpoint(source, patch, direction)
+        self.state_store.put(target_key, source)
+
+    def undo(self, session_id, image_signature, action_stack):
+        """
+        Makes sure that the state preceding the last action of the stack is
+        cached, by applying the patch of that action backward on the current
+        state if needed. It is called before the last action is popped.
+        """
+        self._restore(session_id, image_signature, action_stack, 'before')
+
+    def redo(self, session_id, image_signature, action_stack):
+        """
+        Makes sure that the state of the stack is cached, by applying the
+        patch of its last action forward on the previous state if needed. It
+        is called after the redone action is pushed back on the stack.
+        """
+        self._restore(session_id, image_signature, action_stack, 'after')
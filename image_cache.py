@@ -0,0 +1,305 @@
+"""
+Flask-Caching backends storing the PIL images with the binary codec of
+codec.py instead of pickling them, and evicting the least recently used
+entries based on their size in bytes rather than on their number.
+
+They are selected with the CACHE_TYPE config, e.g. 'image_cache.redis', and
+configured with:
+    CACHE_MAX_BYTES: The byte budget of the cache (0 disables the eviction)
+    CACHE_COMPRESS_IMAGES: Whether the pixel bytes are compressed with zlib
+"""
+import mmap
+import os
+import pickle
+import tempfile
+import time
+
+from werkzeug.contrib.cache import RedisCache, FileSystemCache
+
+from codec import MAGIC, can_encode, encode_image, is_encoded_image, \
+    decode_image
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+
+class ImageRedisCache(RedisCache):
+    """
+    Redis cache storing the encoded images as raw values. The size and the
+    last access time of every value are tracked inside Redis, so the budget
+    is shared by all the workers and covers the pickled values (figures,
+    histograms, checkpoints) as well as the images.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, compress=False, **kwargs):
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self.compress = compress
+
+        self._sizes_key = self.key_prefix + 'image-cache-sizes'
+        self._access_key = self.key_prefix + 'image-cache-access'
+        self._total_key = self.key_prefix + 'image-cache-total'
+
+    def dump_object(self, value):
+        if can_encode(value):
+            return encode_image(value, compress=self.compress)
+
+        return super().dump_object(value)
+
+    def load_object(self, value):
+        if is_encoded_image(value):
+            return decode_image(value)
+
+        return super().load_object(value)
+
+    def _touch(self, key):
+        # ZADD is sent as a raw command, since its signature differs between
+        # the versions of redis-py. XX only updates the keys that are still
+        # tracked, so a read racing with a delete does not bring them back.
+        self._client.execute_command(
+            'ZADD', self._access_key, 'XX', time.time(), key)
+
+    def get(self, key):
+        value = self._client.get(self.key_prefix + key)
+
+        if value is not None:
+            self._touch(key)
+
+        return self.load_object(value)
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._store(key, value, timeout, only_new=True)
+
+    def set_many(self, mapping, timeout=None):
+        results = [self.set(key, value, timeout)
+                   for key, value in mapping.items()]
+
+        return all(results)
+
+    def _store(self, key, value, timeout, only_new=False):
+        dump = self.dump_object(value)
+
+        timeout = self._normalize_timeout(timeout)
+        result = self._client.set(
+            name=self.key_prefix + key, value=dump,
+            ex=None if timeout == -1 else timeout, nx=only_new)
+
+        if result:
+            self._track(key, len(dump))
+
+        return bool(result)
+
+    def _track(self, key, n_bytes):
+        previous = self._client.hget(self._sizes_key, key)
+
+        pipe = self._client.pipeline(transaction=False)
+        pipe.hset(self._sizes_key, key, n_bytes)
+        pipe.incr(self._total_key, n_bytes - int(previous or 0))
+        pipe.execute_command('ZADD', self._access_key, time.time(), key)
+        total = pipe.execute()[1]
+
+        if self.max_bytes and total > self.max_bytes:
+            self._evict(total)
+
+    def _untrack(self, keys):
+        for key in keys:
+            size = self._client.hget(self._sizes_key, key)
+
+            # The key is removed from the access times even without a size,
+            # otherwise the eviction would keep finding it
+            pipe = self._client.pipeline(transaction=False)
+            pipe.hdel(self._sizes_key, key)
+            pipe.zrem(self._access_key, key)
+            removed = pipe.execute()[0]
+
+            # Only the worker that removed the size subtracts it
+            if removed and size is not None:
+                self._client.incr(self._total_key, -int(size))
+
+    def _evict(self, total, batch_size=16):
+        # Remove the least recently used values until the cache fits in its
+        # budget. The values that already expired are only untracked.
+        while total > self.max_bytes:
+            keys = self._client.zrange(self._access_key, 0, batch_size - 1)
+            if not keys:
+                break
+
+            for key in keys:
+                key = key.decode('utf-8') if isinstance(key, bytes) else key
+                size = int(self._client.hget(self._sizes_key, key) or 0)
+
+                super().delete(key)
+                self._untrack([key])
+
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def delete(self, key):
+        self._untrack([key])
+        return super().delete(key)
+
+    def delete_many(self, *keys):
+        self._untrack(keys)
+        return super().delete_many(*keys)
+
+
+class ImageFileSystemCache(FileSystemCache):
+    """
+    File system cache storing the images as raw pixel buffers, which are read
+    through memory maps instead of being unpickled.
+
+    Only the images whose memory layout matches their raw bytes (the L, RGBA
+    and CMYK modes) are loaded without a copy, as an Image.frombuffer over
+    the map, so the workers of the host share their pages in the page cache.
+    PIL holds the RGB images with 4 bytes per pixel, so they are unpacked
+    from the map into a private copy of each worker: the map then only saves
+    the intermediate bytes of a read.
+
+    An image file contains the pickled expiration time, like the other cache
+    files, followed by the image encoded by codec.py. Compressing the images
+    (CACHE_COMPRESS_IMAGES) saves disk space, but they are then copied when
+    they are loaded.
+
+    The least recently used files are removed when the total size of the
+    directory exceeds the budget. The total is estimated by each worker, and
+    computed exactly from the directory before pruning. This is the only
+    eviction: the threshold on the number of files of FileSystemCache is
+    disabled, since its pruning removes every third file, including the
+    entries that never expire.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, compress=False,
+                 **kwargs):
+        super().__init__(cache_dir, threshold=0, **kwargs)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._total_bytes = self._directory_size()
+
+    def _directory_size(self):
+        total = 0
+
+        for filename in self._list_dir():
+            try:
+                total += os.path.getsize(filename)
+            except OSError:
+                pass
+
+        return total
+
+    def get(self, key):
+        filename = self._get_filename(key)
+
+        try:
+            with open(filename, 'rb') as f:
+                expires = pickle.load(f)
+                if expires != 0 and expires < time.time():
+                    os.remove(filename)
+                    return None
+
+                offset = f.tell()
+                if f.read(len(MAGIC)) != MAGIC:
+                    f.seek(offset)
+                    return pickle.load(f)
+
+                # The map stays valid after the file is closed, and even after
+                # it is replaced or removed
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # Mark the file as recently used
+            os.utime(filename)
+
+        except (IOError, OSError, pickle.PickleError):
+            return None
+
+        return decode_image(memoryview(buffer)[offset:])
+
+    def set(self, key, value, timeout=None, mgmt_element=False):
+        if mgmt_element:
+            return super().set(key, value, timeout, mgmt_element=True)
+
+        if not can_encode(value):
+            result = super().set(key, value, timeout)
+            if result:
+                self._count_file(key)
+            return result
+
+        data = encode_image(value, compress=self.compress)
+
+        self._total_bytes += len(data)
+        if self.max_bytes and self._total_bytes > self.max_bytes:
+            self._prune_bytes()
+
+        timeout = self._normalize_timeout(timeout)
+        filename = self._get_filename(key)
+        try:
+            fd, tmp = tempfile.mkstemp(
+                suffix=self._fs_transaction_suffix, dir=self._path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(timeout, f, 1)
+                f.write(data)
+            os.replace(tmp, filename)
+            os.chmod(filename, self._mode)
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    def _count_file(self, key):
+        try:
+            self._total_bytes += os.path.getsize(self._get_filename(key))
+        except OSError:
+            return
+
+        if self.max_bytes and self._total_bytes > self.max_bytes:
+            self._prune_bytes()
+
+    def _prune_bytes(self):
+        entries = []
+        for filename in self._list_dir():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in entries)
+
+        # Free a margin below the budget, to avoid pruning on every set
+        target = 0.9 * self.max_bytes
+        for _, size, filename in sorted(entries):
+            if total <= target:
+                break
+
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+        self._total_bytes = total
+
+
+def redis(app, config, args, kwargs):
+    from redis import from_url as redis_from_url
+
+    kwargs.update(dict(
+        host=redis_from_url(config['CACHE_REDIS_URL']),
+        key_prefix=config.get('CACHE_KEY_PREFIX'),
+        max_bytes=config.get('CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+        compress=config.get('CACHE_COMPRESS_IMAGES', False)
+    ))
+
+    return ImageRedisCache(*args, **kwargs)
+
+
+def filesystem(app, config, args, kwargs):
+    args.insert(0, config['CACHE_DIR'])
+    kwargs.update(dict(
+        max_bytes=config.get('CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+        compress=config.get('CACHE_COMPRESS_IMAGES', False)
+    ))
+
+    return ImageFileSystemCache(*args, **kwargs)
@@ -0,0 +1,479 @@
+"""
+Load test simulating concurrent editing sessions on the app.
+
+Every worker process imports the app, as a gunicorn worker would, and runs
+scripted sessions in concurrent threads through the Flask test client, so
+that the requests go through the same Dash callback endpoint as the browser
+(_dash-update-component). A session loads the layout, uploads an image, then
+applies a sequence of filters and enhancements over the whole image, a
+rectangle or a lasso, and undoes some of them. After every step, it also
+fetches the displayed image and the histogram, like the browser does.
+
+The workers share a temporary cache directory and a temporary local storage,
+so it runs offline and leaves nothing behind.
+
+Usage:
+    python loadtest.py --workers 4 --concurrency 4 --sessions 32 --steps 10
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from benchmark import synthetic_image
+
+FILTERS = ('blur', 'contour', 'detail', 'edge_enhance', 'emboss', 'sharpen',
+           'smooth')
+ENHANCEMENTS = ('color', 'contrast', 'brightness', 'sharpness')
+
+# Probability that a step of a session undoes the last action
+UNDO_PROBABILITY = 0.2
+
+# Number of points of the lasso selections
+LASSO_POINTS = (20, 200)
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, q):
+    """
+    :return: The q-th percentile of the sorted values, by nearest rank
+    """
+    if not sorted_values:
+        return None
+
+    rank = max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def random_rectangle(rng, size):
+    width, height = size
+    x = sorted(rng.uniform(0, width) for _ in range(2))
+    y = sorted(rng.uniform(0, height) for _ in range(2))
+
+    return {'range': {'x': x, 'y': y}}
+
+
+def random_lasso(rng, size):
+    width, height = size
+    n_points = rng.randint(*LASSO_POINTS)
+    center_x = rng.uniform(0.2, 0.8) * width
+    center_y = rng.uniform(0.2, 0.8) * height
+    radius = rng.uniform(0.05, 0.2) * min(width, height)
+
+    x, y = [], []
+    for i in range(n_points):
+        angle = 2 * math.pi * i / n_points
+        r = radius * rng.uniform(0.8, 1.2)
+        x.append(center_x + r * math.cos(angle))
+        y.append(center_y + r * math.sin(angle))
+
+    return {'lassoPoints': {'x': x, 'y': y}}
+
+
+def session_script(rng, size, n_steps):
+    """
+    Generates the steps of a session: dicts with the filter or enhancement to
+    run and its selection, or None for an undo.
+    """
+    steps = []
+    n_actions = 0
+
+    for _ in range(n_steps):
+        if n_actions and rng.random() < UNDO_PROBABILITY:
+            steps.append(None)
+            n_actions -= 1
+            continue
+
+        selection = rng.choice([None, 'rectangle', 'lasso'])
+        if selection == 'rectangle':
+            selected_data = random_rectangle(rng, size)
+        elif selection == 'lasso':
+            selected_data = random_lasso(rng, size)
+        else:
+            selected_data = None
+
+        step = {'filter': None, 'enhance': None, 'factor': 1,
+                'selectedData': selected_data}
+        if rng.random() < 0.5:
+            step['filter'] = rng.choice(FILTERS)
+        else:
+            step['enhance'] = rng.choice(ENHANCEMENTS)
+            step['factor'] = round(rng.uniform(0.5, 2), 1)
+
+        steps.append(step)
+        n_actions += 1
+
+    return steps
+
+
+def find_component(node, component_id):
+    if isinstance(node, dict):
+        if node.get('props', {}).get('id') == component_id:
+            return node
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+
+    for child in children:
+        found = find_component(child, component_id)
+        if found is not None:
+            return found
+
+    return None
+
+
+class Session:
+    """
+    A scripted editing session, which sends the requests of the browser and
+    records their latencies.
+    """
+
+    def __init__(self, app, client, latencies, errors):
+        self.app = app
+        self.client = client
+        self.latencies = latencies
+        self.errors = errors
+
+        # The requests go straight to the server, under the prefix of its
+        # routes
+        self.prefix = app.config.routes_pathname_prefix
+
+        # Values of the components, by (id, property)
+        self.values = {}
+
+    def request(self, kind, method, url, **kwargs):
+        t_start = time.perf_counter()
+        response = getattr(self.client, method)(url, **kwargs)
+        self.latencies.setdefault(kind, []).append(
+            time.perf_counter() - t_start)
+
+        if response.status_code != 200:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            return None
+
+        return response
+
+    def update(self, kind, output_id, output_property):
+        """
+        Calls the callback of an output with the current values of its inputs
+        and states, as the browser does.
+        """
+        callback = self.app.callback_map[f'{output_id}.{output_property}']
+
+        def with_values(dependencies):
+            return [dict(d, value=self.values.get((d['id'], d['property'])))
+                    for d in dependencies]
+
+        payload = {
+            'output': {'id': output_id, 'property': output_property},
+            'inputs': with_values(callback['inputs']),
+            'state': with_values(callback['state'])
+        }
+
+        response = self.request(
+            kind, 'post', self.prefix + '_dash-update-component',
+            json=payload)
+        if response is None:
+            return None
+
+        return response.get_json()['response']['props'][output_property]
+
+    def click(self, button_id):
+        key = (button_id, 'n_clicks')
+        self.values[key] = (self.values.get(key) or 0) + 1
+
+    def refresh(self):
+        """
+        Updates the interactive image, then loads the displayed image and the
+        histogram.
+        """
+        children = self.update('update', 'div-interactive-image', 'children')
+        if children is None:
+            return
+
+        figure = children[0]['props']['figure']
+        self.values[('interactive-image', 'figure')] = figure
+        self.values[('div-storage', 'children')] = \
+            children[1]['props']['children']
+
+        self.request('image', 'get', figure['layout']['images'][0]['source'])
+        self.update('histogram', 'graph-histogram-colors', 'figure')
+
+    def run(self, image_data, filename, steps):
+        response = self.request('layout', 'get', self.prefix + '_dash-layout')
+        if response is None:
+            return
+
+        layout = response.get_json()
+        for component_id, prop in (('session-id', 'children'),
+                                   ('div-storage', 'children'),
+                                   ('radio-selection-mode', 'value'),
+                                   ('radio-encoding-format', 'value'),
+                                   ('slider-enhancement-factor', 'value')):
+            component = find_component(layout, component_id)
+            self.values[(component_id, prop)] = component['props'].get(prop)
+
+        response = self.request('upload', 'post', self.prefix + 'upload',
+                                data=image_data,
+                                headers={'X-Filename': filename})
+        if response is None:
+            return
+
+        self.values[('input-upload-handle', 'value')] = \
+            json.dumps(response.get_json())
+        self.refresh()
+
+        for step in steps:
+            if step is None:
+                self.click('button-undo')
+            else:
+                self.values.update({
+                    ('dropdown-filters', 'value'): step['filter'],
+                    ('dropdown-enhance', 'value'): step['enhance'],
+                    ('slider-enhancement-factor', 'value'): step['factor'],
+                    ('interactive-image', 'selectedData'):
+                        step['selectedData'],
+                })
+                self.click('button-run-operation')
+
+            self.refresh()
+
+
+def encode_jpeg(image):
+    buffer = BytesIO()
+    image.save(buffer, format='jpeg', quality=90)
+    return buffer.getvalue()
+
+
+def run_worker(worker_index, session_indices, config, directory):
+    """
+    Runs sessions inside a worker process.
+    :return: The latencies by kind of request, the error counts, the duration
+    of the sessions and the memory used by the worker
+    """
+    # The app must not reach the Redis server and the S3 bucket of the
+    # environment. The empty bucket name is kept by load_dotenv, which never
+    # overrides the variables already set.
+    os.environ.pop('REDIS_URL', None)
+    os.environ['BUCKET_NAME'] = ''
+    os.environ['CACHE_DIR'] = os.path.join(directory, 'cache')
+    os.environ['STORAGE_DIR'] = os.path.join(directory, 'storage')
+
+    # The worker imports the app, which warms up its cache
+    import app as dash_app
+
+    rss_idle = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    pending = list(session_indices)
+
+    def run_sessions():
+        thread_latencies, thread_errors = {}, {}
+        client = dash_app.server.test_client()
+
+        while True:
+            with lock:
+                if not pending:
+                    break
+                session_index = pending.pop(0)
+
+            rng = random.Random(config['seed'] + session_index)
+
+            # Every session uploads a different image, unless they share it
+            seed = 0 if config['same_image'] else session_index
+            image = synthetic_image(config['megapixels'], seed=seed)
+            steps = session_script(rng, image.size, config['steps'])
+
+            Session(dash_app.app, client, thread_latencies, thread_errors).run(
+                encode_jpeg(image), f'image-{session_index}.jpg', steps)
+
+        with lock:
+            for kind, values in thread_latencies.items():
+                latencies.setdefault(kind, []).extend(values)
+            for kind, count in thread_errors.items():
+                errors[kind] = errors.get(kind, 0) + count
+
+    threads = [threading.Thread(target=run_sessions)
+               for _ in range(config['concurrency'])]
+
+    t_start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - t_start
+
+    return {
+        'worker': worker_index,
+        'sessions': len(session_indices),
+        'latencies': latencies,
+        'errors': errors,
+        'duration': duration,
+        # ru_maxrss is in kilobytes on Linux
+        'rss_idle_mb': rss_idle / 1024,
+        'rss_peak_mb':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def summarize(results):
+    """
+    Aggregates the results of the workers.
+    :return: The report, with the throughput, the latency percentiles by
+    kind of request, and the memory of each worker
+    """
+    latencies = {}
+    errors = {}
+    for result in results:
+        for kind, values in result['latencies'].items():
+            latencies.setdefault(kind, []).extend(values)
+        for kind, count in result['errors'].items():
+            errors[kind] = errors.get(kind, 0) + count
+
+    n_requests = sum(len(values) for values in latencies.values())
+    n_sessions = sum(result['sessions'] for result in results)
+
+    # The workers run concurrently, so their throughputs add up
+    report = {
+        'sessions': n_sessions,
+        'requests': n_requests,
+        'errors': errors,
+        'requests_per_sec': sum(
+            sum(len(v) for v in r['latencies'].values()) / r['duration']
+            for r in results if r['duration'] > 0),
+        'sessions_per_sec': sum(
+            r['sessions'] / r['duration']
+            for r in results if r['duration'] > 0),
+        'latency': {},
+        'workers': [{
+            'worker': r['worker'],
+            'sessions': r['sessions'],
+            'duration': r['duration'],
+            'rss_idle_mb': r['rss_idle_mb'],
+            'rss_peak_mb': r['rss_peak_mb']
+        } for r in results]
+    }
+
+    for kind, values in sorted(latencies.items()):
+        values = sorted(values)
+        report['latency'][kind] = dict(
+            count=len(values),
+            mean=sum(values) / len(values),
+            **{f'p{q}': percentile(values, q) for q in PERCENTILES})
+
+    return report
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions, {report['requests']} requests: "
+          f"{report['requests_per_sec']:.1f} requests/sec, "
+          f"{report['sessions_per_sec']:.2f} sessions/sec")
+
+    if report['errors']:
+        print(f"Errors: {report['errors']}")
+
+    print()
+    print(f"{'request':<12}{'count':>8}" +
+          ''.join(f"{f'p{q} (ms)':>12}" for q in PERCENTILES))
+    for kind, stats in report['latency'].items():
+        print(f"{kind:<12}{stats['count']:>8}" +
+              ''.join(f"{stats[f'p{q}'] * 1000:>12.1f}" for q in PERCENTILES))
+
+    print()
+    for worker in report['workers']:
+        print(f"Worker {worker['worker']}: {worker['sessions']} sessions in "
+              f"{worker['duration']:.1f} sec, "
+              f"{worker['rss_idle_mb']:.0f} MB after start, "
+              f"{worker['rss_peak_mb']:.0f} MB peak")
+
+
+def run_load_test(workers=1,
+                  concurrency=4,
+                  sessions=16,
+                  steps=10,
+                  megapixels=1,
+                  same_image=False,
+                  seed=0):
+    """
+    Runs the sessions, spread over the worker processes.
+    :return: The report of summarize
+    """
+    config = {
+        'concurrency': concurrency,
+        'steps': steps,
+        'megapixels': megapixels,
+        'same_image': same_image,
+        'seed': seed
+    }
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        # The workers are spawned, so that each one imports its own app
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers) as pool:
+            results = pool.starmap(run_worker, [
+                (i, list(range(i, sessions, workers)), config, directory)
+                for i in range(workers)
+            ])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return summarize(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulates concurrent editing sessions on the app.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Number of concurrent sessions per worker")
+    parser.add_argument('--sessions', type=int, default=16,
+                        help="Total number of sessions")
+    parser.add_argument('--steps', type=int, default=10,
+                        help="Number of operations or undos per session")
+    parser.add_argument('--megapixels', type=float, default=1,
+                        help="Size of the uploaded images")
+    parser.add_argument('--same-image', action='store_true',
+                        help="Upload the same image in every session")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the session scripts")
+    parser.add_argument('--output', default=None,
+                        help="JSON file in which the report is written")
+    args = parser.parse_args(argv)
+
+    report = run_load_test(
+        workers=args.workers,
+        concurrency=args.concurrency,
+        sessions=args.sessions,
+        steps=args.steps,
+        megapixels=args.megapixels,
+        same_image=args.same_image,
+        seed=args.seed
+    )
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
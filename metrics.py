@@ -0,0 +1,294 @@
+"""
+Latency instrumentation of the image pipeline.
+
+The duration of each stage (storage fetch, decoding, action replays, lasso
+masks, encoding, histogram...) is recorded inside histograms, and the hits and
+misses of the caches inside counters. They are exposed in the Prometheus text
+format by the route registered with init_app. The values are kept by each
+process, so every worker of a deployment is scraped separately.
+
+It is configured with the environment variables:
+    METRICS_ENABLED: Whether the stages are measured (true by default)
+    TRACE_REQUESTS: Whether the stages of each request are logged
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS', '').lower() == 'true'
+
+# Upper bounds of the buckets of the duration histograms, in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"') \
+            .replace('\n', r'\n')
+
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+class Histogram:
+    """
+    Prometheus histogram, with a series of buckets for each combination of
+    label values.
+    """
+
+    def __init__(self, name, description, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+        self._lock = threading.Lock()
+        # labels -> [counts of each bucket, sum, count]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0., 0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(key, [('le', bound)])
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+
+                labels = _format_labels(key, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter, with a value for each combination of label values.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} counter']
+
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+
+        return lines
+
+
+stage_duration = Histogram(
+    'image_pipeline_stage_duration_seconds',
+    'Duration of the stages of the image pipeline.')
+
+request_duration = Histogram(
+    'image_pipeline_request_duration_seconds',
+    'Duration of the requests, by endpoint.')
+
+cache_requests = Counter(
+    'image_pipeline_cache_requests_total',
+    'Lookups of the caches of the image pipeline, by result.')
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# Returned by timed when the metrics are disabled, so that measuring a stage
+# then costs a single function call
+_NULL_TIMER = _NullTimer()
+
+
+@contextmanager
+def _timer(stage, labels):
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t_start
+        stage_duration.observe(duration, stage=stage, **labels)
+
+        if TRACE_REQUESTS and has_request_context():
+            g.setdefault('metrics_trace', []).append((stage, labels, duration))
+
+
+def timed(stage, **labels):
+    """
+    Context manager measuring the duration of a stage of the pipeline.
+    :param stage: The name of the stage, e.g. 'decode'
+    :param labels: Additional labels of the measure, e.g. the operation
+    """
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+
+    return _timer(stage, labels)
+
+
+def count_cache(cache_name, result):
+    """
+    Counts a lookup of a cache.
+    :param result: 'hit' or 'miss', or 'partial' when only a part of the
+    value was found
+    """
+    if not METRICS_ENABLED:
+        return
+
+    cache_requests.inc(cache=cache_name, result=result)
+
+    if TRACE_REQUESTS and has_request_context():
+        g.setdefault('metrics_trace', []).append(
+            (f'{cache_name}_cache', {'result': result}, None))
+
+
+# Set by the memoized functions when their value is computed, to tell the
+# lookups that missed the cache apart from the hits
+_lookup = threading.local()
+
+
+@contextmanager
+def _cache_lookup(cache_name):
+    _lookup.computed = False
+    try:
+        yield
+    finally:
+        count_cache(cache_name, 'miss' if _lookup.computed else 'hit')
+
+
+def cache_lookup(cache_name):
+    """
+    Context manager counting the hits and misses of a memoized function
+    called inside it, which must call mark_computed when it actually runs.
+    """
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+
+    return _cache_lookup(cache_name)
+
+
+def mark_computed():
+    _lookup.computed = True
+
+
+def expose():
+    """
+    :return: All the metrics, in the Prometheus text format
+    """
+    lines = []
+    for metric in (stage_duration, request_duration, cache_requests):
+        lines += metric.expose()
+
+    return '\n'.join(lines) + '\n'
+
+
+def _request_endpoint():
+    # The requests matching no route share a single label, since their paths
+    # are arbitrary
+    endpoint = request.endpoint or 'unmatched'
+
+    # All the callbacks share the same endpoint, and are told apart by the
+    # component they update
+    if request.path.endswith('_dash-update-component'):
+        body = request.get_json(silent=True) or {}
+        output = body.get('output')
+        if isinstance(output, dict):
+            output = output.get('id')
+        endpoint += f':{output}'
+
+    return endpoint
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+
+    duration = time.perf_counter() - g.metrics_start
+    endpoint = _request_endpoint()
+    request_duration.observe(duration, endpoint=endpoint)
+
+    if TRACE_REQUESTS:
+        stages = []
+        for stage, labels, seconds in g.get('metrics_trace', []):
+            name = stage
+            if labels:
+                name += '[' + ','.join(str(v) for v in labels.values()) + ']'
+            if seconds is not None:
+                name += f'={seconds * 1000:.1f}ms'
+            stages.append(name)
+
+        logger.info("%s %s in %.1f ms: %s", request.method, endpoint,
+                    duration * 1000, ' '.join(stages) or '-')
+
+    return response
+
+
+def init_app(server, route='/metrics'):
+    """
+    Registers the metrics route on the Flask server, and measures the
+    duration of its requests.
+    """
+    @server.route(route)
+    def serve_metrics():
+        if not METRICS_ENABLED:
+            abort(404)
+
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
+
+    if not METRICS_ENABLED:
+        return
+
+    server.before_request(_before_request)
+    server.after_request(_after_request)
+
+    if TRACE_REQUESTS and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
@@ -0,0 +1,190 @@
+import json
+import os
+
+import metrics
+from checkpoint import create_checkpoint, apply_checkpoint
+from upload import content_hash
+from utils import apply_action
+
+# Every KEYFRAME_INTERVAL actions, the full image state is cached. The states
+# in between are cached as checkpoints relative to their previous state.
+KEYFRAME_INTERVAL = int(os.environ.get('KEYFRAME_INTERVAL', 8))
+
+# Timeout of the cached states, in seconds. The cache backends also evict the
+# least recently used states beyond their byte budget, and an evicted state
+# is simply replayed from the nearest cached one, or from the original.
+STATE_TIMEOUT = int(os.environ.get('STATE_TIMEOUT', 3600))
+
+
+def get_action_key(parent_key, action):
+    """
+    Computes the key of the state obtained by applying an action on the state
+    identified by parent_key.
+    """
+    hash_obj = content_hash(parent_key.encode('utf-8'))
+    hash_obj.update(json.dumps(action, sort_keys=True).encode('utf-8'))
+
+    return hash_obj.hexdigest()
+
+
+def get_prefix_keys(image_signature, action_stack):
+    """
+    Computes the keys of all the states reached while applying the action
+    stack. The key of the original image is its signature, and the key of
+    each following state is the hash of the previous key and of the action,
+    so identical edit prefixes on identical images share the same keys.
+    :return: The list of the len(action_stack) + 1 keys
+    """
+    keys = [image_signature]
+
+    for action in action_stack:
+        keys.append(get_action_key(keys[-1], action))
+
+    return keys
+
+
+def get_operation_name(action):
+    """
+    :return: The name of the filter or enhancement of an action
+    """
+    if action['type'] == 'enhance':
+        return action['operation']['enhancement']
+
+    return action['operation']
+
+
+class SharedStateStore:
+    """
+    Cache of the image states, keyed by action-prefix hashes rather than by
+    session, so that they are computed once and shared across all users.
+
+    Only the original images and one state every KEYFRAME_INTERVAL actions
+    are cached as full images. The other states are cached as checkpoints of
+    the pixels changed since their previous state, and rebuilt by applying
+    them on the nearest full image.
+
+    The states are not tracked by the sessions using them: they expire with
+    STATE_TIMEOUT, and the cache backend evicts the least recently used ones
+    when it exceeds its budget.
+    """
+
+    def __init__(self, cache, load_original, timeout=STATE_TIMEOUT):
+        """
+        :param cache: The Flask-Caching Cache object
+        :param load_original: Function returning the original PIL image from
+        its signature
+        :param timeout: The timeout of the states inside the cache
+        """
+        self.cache = cache
+        self.load_original = load_original
+        self.timeout = timeout
+
+    def get_cached(self, key):
+        """
+        :return: The cached image state, or None if it is not in the cache
+        """
+        checkpoints = []
+        entry = self.cache.get('state-' + key)
+
+        # Walk back to the nearest full image
+        while isinstance(entry, dict):
+            checkpoints.append(entry['checkpoint'])
+            entry = self.cache.get('state-' + entry['parent'])
+
+        if entry is None:
+            return None
+
+        image = entry
+        for checkpoint in reversed(checkpoints):
+            apply_checkpoint(image, checkpoint, 'after')
+
+        return image
+
+    def has(self, key):
+        """
+        :return: Whether the state is cached, as a full image or as a
+        checkpoint, checked without loading it. If the chain of a checkpoint
+        is broken, the state is still replayed by get_image.
+        """
+        # The backend of a Flask-Caching object is its cache attribute
+        backend = getattr(self.cache, 'cache', self.cache)
+
+        return backend.has('state-' + key)
+
+    def get_checkpoint(self, key):
+        """
+        :return: The checkpoint going from the previous state to this state,
+        or None if the state is not cached as a checkpoint
+        """
+        entry = self.cache.get('state-' + key)
+
+        if not isinstance(entry, dict):
+            return None
+
+        return entry['checkpoint']
+
+    def put(self, key, image):
+        """
+        Caches the full image of a state. It is stored as is, so the cache
+        backend can serialize it with its image codec.
+        """
+        self.cache.set('state-' + key, image, timeout=self.timeout)
+
+    def put_checkpoint(self, key, parent_key, checkpoint):
+        """
+        Caches a state as the checkpoint going from its previous state.
+        """
+        self.cache.set('state-' + key, {
+            'parent': parent_key,
+            'checkpoint': checkpoint
+        }, timeout=self.timeout)
+
+    def get_image(self, image_signature, action_stack):
+        """
+        Retrieves the image state obtained by applying the action stack on
+        the original image. Starting from the longest prefix of the stack
+        found in the cache, the remaining actions are replayed and every new
+        intermediate state is cached.
+        :return: The PIL image
+        """
+        keys = get_prefix_keys(image_signature, action_stack)
+
+        # Look for the deepest state already computed
+        with metrics.timed('state_lookup'):
+            for depth in range(len(keys) - 1, -1, -1):
+                im_pil = self.get_cached(keys[depth])
+                if im_pil is not None:
+                    break
+            else:
+                depth = None
+
+        if depth is None:
+            metrics.count_cache('state', 'miss')
+
+            depth = 0
+            im_pil = self.load_original(image_signature)
+            self.put(keys[0], im_pil)
+        elif depth < len(action_stack):
+            metrics.count_cache('state', 'partial')
+        else:
+            metrics.count_cache('state', 'hit')
+
+        for i in range(depth, len(action_stack)):
+            action = action_stack[i]
+            operation = get_operation_name(action)
+
+            # The cache stores serialized copies, so the image can be
+            # modified in-place after being set
+            if (i + 1) % KEYFRAME_INTERVAL == 0:
+                with metrics.timed('replay', operation=operation):
+                    apply_action(im_pil, action)
+                self.put(keys[i + 1], im_pil)
+            else:
+                before = im_pil.copy()
+                with metrics.timed('replay', operation=operation):
+                    apply_action(im_pil, action)
+                with metrics.timed('checkpoint'):
+                    checkpoint = create_checkpoint(before, im_pil)
+                self.put_checkpoint(keys[i + 1], keys[i], checkpoint)
+
+        return im_pil
@@ -0,0 +1,91 @@
+import os
+import shutil
+
+import boto3
+import requests
+
+
+class S3Storage:
+    """
+    Stores the original images inside a bucket, using the S3 interoperability
+    API of Google Cloud Storage. Files are transferred through pre-signed
+    URLs, and the uploads are streamed from file objects.
+    """
+
+    def __init__(self,
+                 bucket_name,
+                 access_key_id,
+                 secret_access_key,
+                 endpoint_url="https://storage.googleapis.com"):
+        self.bucket_name = bucket_name
+        self.client = boto3.client('s3',
+                                   endpoint_url=endpoint_url,
+                                   aws_access_key_id=access_key_id,
+                                   aws_secret_access_key=secret_access_key)
+
+    def _presigned_url(self, client_method, key):
+        url = self.client.generate_presigned_url(
+            ClientMethod=client_method,
+            Params={
+                'Bucket': self.bucket_name,
+                'Key': key
+            }
+        )
+
+        # A key replacement is required for URL pre-sign in gcp
+        return url.replace('AWSAccessKeyId', 'GoogleAccessId')
+
+    def put(self, key, fileobj):
+        """
+        Streams the content of a file object into the bucket.
+        :param key: The key under which the file is stored
+        :param fileobj: A binary file object, read until the end
+        :return: The response of the storage server
+        """
+        url = self._presigned_url('put_object', key)
+        response = requests.put(url, data=fileobj)
+        response.raise_for_status()
+
+        return response
+
+    def get(self, key):
+        """
+        :return: The bytes stored under the key
+        """
+        url = self._presigned_url('get_object', key)
+        response = requests.get(url)
+        response.raise_for_status()
+
+        return response.content
+
+
+class LocalStorage:
+    """
+    Stores the original images as files inside a local directory. It is used
+    when no bucket is configured, e.g. for development and offline runs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        # Keys come from the clients, so they must not escape the directory
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            raise ValueError(f"Invalid storage key: {key!r}")
+
+        return os.path.join(self.directory, key)
+
+    def put(self, key, fileobj):
+        # Write to a temporary file first, so that readers never see a
+        # partially written image
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
@@ -0,0 +1,150 @@
+"""
+Checks that the checkpoints reconstruct the image states bit-exactly, both
+directly and through the chains of checkpoints of the state store.
+
+Run with:
+    python -m pytest test_checkpoint.py
+"""
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.contrib.cache import SimpleCache
+
+import state_store
+from checkpoint import create_checkpoint, apply_checkpoint
+from image_cache import ImageFileSystemCache
+from state_store import SharedStateStore, get_prefix_keys
+from utils import apply_action
+
+MODES = ('RGB', 'RGBA', 'L')
+
+
+def random_image(mode, size=(120, 90), seed=0):
+    random = np.random.RandomState(seed)
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    shape = (size[1], size[0], bands) if bands > 1 else (size[1], size[0])
+
+    return Image.fromarray(
+        random.randint(0, 256, size=shape, dtype=np.uint8), mode)
+
+
+def action_stack(n_actions):
+    """
+    :return: Actions alternating filters and enhancements over the whole
+    image, a rectangle and a lasso
+    """
+    selections = [
+        None,
+        {'range': {'x': [10, 70], 'y': [20, 60]}},
+        {'lassoPoints': {'x': [15, 100, 60], 'y': [10, 25, 80]}}
+    ]
+    actions = []
+
+    for i in range(n_actions):
+        if i % 2 == 0:
+            actions.append({
+                'operation': ['blur', 'emboss', 'sharpen'][i % 3],
+                'type': 'filter',
+                'selectedData': selections[i % 3]
+            })
+        else:
+            actions.append({
+                'operation': {
+                    'enhancement': 'contrast',
+                    'enhancement_factor': 1.5
+                },
+                'type': 'enhance',
+                'selectedData': selections[i % 3]
+            })
+
+    return actions
+
+
+def replay(image, actions):
+    image = image.copy()
+    for action in actions:
+        apply_action(image, action)
+
+    return image
+
+
+def assert_same_pixels(image, expected):
+    assert image.mode == expected.mode
+    assert image.size == expected.size
+    assert image.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_checkpoint_both_directions(mode):
+    before = random_image(mode)
+    after = before.copy()
+    after.paste(random_image(mode, size=(30, 20), seed=1), (40, 50))
+
+    checkpoint = create_checkpoint(before, after)
+    assert checkpoint['box'] == (40, 50, 70, 70)
+
+    redone = before.copy()
+    apply_checkpoint(redone, checkpoint, 'after')
+    assert_same_pixels(redone, after)
+
+    undone = after.copy()
+    apply_checkpoint(undone, checkpoint, 'before')
+    assert_same_pixels(undone, before)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_checkpoint_of_actions(mode):
+    before = random_image(mode)
+
+    for action in action_stack(3):
+        after = replay(before, [action])
+        checkpoint = create_checkpoint(before, after)
+
+        redone = before.copy()
+        apply_checkpoint(redone, checkpoint, 'after')
+        assert_same_pixels(redone, after)
+
+        undone = after.copy()
+        apply_checkpoint(undone, checkpoint, 'before')
+        assert_same_pixels(undone, before)
+
+        before = after
+
+
+def test_checkpoint_without_changes():
+    image = random_image('RGB')
+    checkpoint = create_checkpoint(image, image.copy())
+    assert checkpoint['box'] is None
+
+    copy = image.copy()
+    apply_checkpoint(copy, checkpoint, 'before')
+    assert_same_pixels(copy, image)
+
+
+@pytest.fixture(params=['simple', 'filesystem'])
+def cache(request, tmp_path):
+    if request.param == 'simple':
+        return SimpleCache(threshold=10 ** 6)
+
+    return ImageFileSystemCache(str(tmp_path))
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_state_store_chain_across_keyframe(cache, mode):
+    original = random_image(mode)
+    actions = action_stack(state_store.KEYFRAME_INTERVAL + 3)
+    store = SharedStateStore(cache, lambda signature: original.copy())
+
+    result = store.get_image('signature', actions)
+    assert_same_pixels(result, replay(original, actions))
+
+    # Every intermediate state, keyframe or checkpoint, is rebuilt exactly
+    # from the cache
+    keys = get_prefix_keys('signature', actions)
+    for depth, key in enumerate(keys):
+        entry = cache.get('state-' + key)
+        is_keyframe = depth % state_store.KEYFRAME_INTERVAL == 0
+        assert isinstance(entry, dict) != is_keyframe
+
+        assert_same_pixels(store.get_cached(key),
+                           replay(original, actions[:depth]))
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import tempfile
+import uuid
+
+from PIL import Image
+
+# Limits enforced on the uploaded images. They can be configured through
+# environment variables.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 20 * 1024 ** 2))
+MAX_UPLOAD_PIXELS = int(os.environ.get('MAX_UPLOAD_PIXELS', 50 * 1000 ** 2))
+
+# Size of the chunks read from the request stream
+CHUNK_SIZE = 64 * 1024
+
+# Uploads smaller than this are kept in memory, larger ones are spooled to disk
+SPOOL_MAX_SIZE = 1024 ** 2
+
+# Maximum side of the preview decoded to check the integrity of JPEG images
+PREVIEW_SIZE = (256, 256)
+
+# Size in bytes of the BLAKE2 digests identifying the images
+DIGEST_SIZE = 20
+
+
+class UploadError(Exception):
+    """
+    Raised when an uploaded file is rejected. The status code is the HTTP
+    code returned by the upload endpoint.
+    """
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def content_hash(data=b''):
+    """
+    Creates the BLAKE2 hash object used to identify images by their content.
+    The hexadecimal digest of the encoded image file is its signature.
+    """
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE)
+
+
+def spool_stream(stream, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Copies a binary stream chunk by chunk into a spooled temporary file,
+    without ever holding more than a chunk of the upload in memory at once.
+    The content hash is computed along the way.
+    :param stream: The binary stream to read, e.g. the body of a request
+    :param max_bytes: The maximum number of bytes accepted
+    :return: The spooled file, rewound to its start, the number of bytes and
+    the hexadecimal content hash
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    hash_obj = content_hash()
+    n_bytes = 0
+
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        n_bytes += len(chunk)
+        if n_bytes > max_bytes:
+            spooled.close()
+            raise UploadError(
+                f"The image is larger than {max_bytes} bytes.", 413)
+
+        spooled.write(chunk)
+        hash_obj.update(chunk)
+
+    if n_bytes == 0:
+        spooled.close()
+        raise UploadError("The uploaded file is empty.")
+
+    spooled.seek(0)
+    return spooled, n_bytes, hash_obj.hexdigest()
+
+
+def inspect_image(fileobj, max_pixels=MAX_UPLOAD_PIXELS):
+    """
+    Checks that a file is an image within the size limit. Only the header is
+    read to get the size, and JPEG images are decoded in draft mode at a
+    reduced scale, which is much cheaper than a full decode.
+    :param fileobj: The binary file object containing the image
+    :param max_pixels: The maximum number of pixels accepted
+    :return: The format and the (width, height) of the image
+    """
+    try:
+        im = Image.open(fileobj)
+        enc_format, size = im.format, im.size
+
+        if size[0] * size[1] > max_pixels:
+            raise UploadError(
+                f"The image has more than {max_pixels} pixels.", 413)
+
+        if enc_format == 'JPEG':
+            im.draft('RGB', PREVIEW_SIZE)
+            im.load()
+        else:
+            im.verify()
+
+    except UploadError:
+        raise
+    except Exception:
+        raise UploadError("The uploaded file is not a valid image.")
+
+    finally:
+        fileobj.seek(0)
+
+    return enc_format, size
+
+
+def ingest_upload(stream, storage):
+    """
+    Ingests an uploaded image from a binary stream: the stream is spooled
+    while enforcing the byte limit, the image is inspected, then it is
+    streamed into the storage under its content hash.
+    :param stream: The binary stream containing the image file
+    :param storage: The storage in which the original image is saved
+    :return: A handle describing the stored image, which is what the Dash
+    callbacks receive instead of the image itself
+    """
+    spooled, n_bytes, image_signature = spool_stream(stream)
+
+    with spooled:
+        enc_format, size = inspect_image(spooled)
+        storage.put(image_signature, spooled)
+
+    return {
+        'image_signature': image_signature,
+        # Distinguishes successive uploads of the same image
+        'upload_id': uuid.uuid4().hex,
+        'format': enc_format,
+        'size': size,
+        'bytes': n_bytes
+    }
+
+
+def ingest_file(path, storage):
+    """
+    Ingests an image file from the disk, with the same checks as the uploads.
+    """
+    with open(path, 'rb') as f:
+        return ingest_upload(f, storage)
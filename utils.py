@@ -1,36 +1,33 @@
 import dash_core_components as dcc
 import dash_html_components as html
+import hashlib
 import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import plotly.graph_objs as go
-import dash_reusable_components as drc
-from PIL import Image, ImageFilter, ImageDraw, ImageEnhance
+from PIL import Image, ImageDraw, ImageEnhance
+
+import metrics
+from filters import FILTERS_DICT, filter_region
 
 
-# [filename, image_signature, action_stack]
+# [filename, image_signature, size, action_stack, redo_stack]
 STORAGE_PLACEHOLDER = json.dumps({
     'filename': None,
     'image_signature': None, 
-    'action_stack': []
+    'size': None,
+    'action_stack': [],
+    'redo_stack': []
 })
 
-IMAGE_STRING_PLACEHOLDER = drc.pil_to_b64(Image.open('images/default.jpg').copy(), enc_format='jpeg')
+IMAGE_PATH_PLACEHOLDER = 'images/default.jpg'
 
 GRAPH_PLACEHOLDER = dcc.Graph(id='interactive-image', style={'height': '80vh'})
 
-# Maps process name to the Image filter corresponding to that process
-FILTERS_DICT = {
-    'blur': ImageFilter.BLUR,
-    'contour': ImageFilter.CONTOUR,
-    'detail': ImageFilter.DETAIL,
-    'edge_enhance': ImageFilter.EDGE_ENHANCE,
-    'edge_enhance_more': ImageFilter.EDGE_ENHANCE_MORE,
-    'emboss': ImageFilter.EMBOSS,
-    'find_edges': ImageFilter.FIND_EDGES,
-    'sharpen': ImageFilter.SHARPEN,
-    'smooth': ImageFilter.SMOOTH,
-    'smooth_more': ImageFilter.SMOOTH_MORE
-}
-
 ENHANCEMENT_DICT = {
     'color': ImageEnhance.Color,
     'contrast': ImageEnhance.Contrast,
@@ -38,37 +35,245 @@ ENHANCEMENT_DICT = {
     'sharpness': ImageEnhance.Sharpness
 }
 
+# Maximum distance, in pixels, between a lasso path and its simplification
+LASSO_TOLERANCE = 0.5
+
+# Total size, in bytes, of the rasterized lasso masks kept in memory
+LASSO_MASK_CACHE_BYTES = int(
+    os.environ.get('LASSO_MASK_CACHE_BYTES', 64 * 1024 ** 2))
+
+
+def simplify_lasso_points(points, tolerance=LASSO_TOLERANCE):
+    """
+    Simplifies a lasso path with the Douglas-Peucker algorithm, removing the
+    points closer than the tolerance to the simplified path. Dense lasso paths
+    have many more points than needed to rasterize them.
+    :param points: Array of shape (n, 2) of the (x, y) coordinates
+    :return: The array of the points that are kept
+    """
+    if len(points) < 3:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    segments = [(0, len(points) - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+
+        direction = points[end] - points[start]
+        inner = points[start + 1:end] - points[start]
+        length = np.hypot(*direction)
+
+        # Distances of the inner points to the segment line
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(direction[0] * inner[:, 1] -
+                               direction[1] * inner[:, 0]) / length
+
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            index += start + 1
+            keep[index] = True
+            segments.append((start, index))
+            segments.append((index, end))
+
+    return points[keep]
+
+
+# Rasterized lasso masks, keyed by image size and hash of the lasso points,
+# and their total size in bytes. They are shared by the threads of the worker.
+_lasso_masks = OrderedDict()
+_lasso_mask_bytes = 0
+_lasso_masks_lock = threading.Lock()
+
+
+def _rasterize_lasso(image_size, points):
+    xy = simplify_lasso_points(points)
+
+    width, height = image_size
+    left = max(int(math.floor(xy[:, 0].min())), 0)
+    upper = max(int(math.floor(xy[:, 1].min())), 0)
+    right = min(int(math.ceil(xy[:, 0].max())) + 1, width)
+    lower = min(int(math.ceil(xy[:, 1].max())) + 1, height)
+
+    if left >= right or upper >= lower:
+        return None, None
+
+    # Draw the polygon relatively to its bounding box
+    xy -= (left, upper)
+    mask = Image.new('L', (right - left, lower - upper))
+    draw = ImageDraw.Draw(mask)
+    draw.polygon([tuple(point) for point in xy], fill=255)
+
+    return (left, upper, right, lower), mask
+
 
 def generate_lasso_mask(image, selectedData):
     """
-    Generates a polygon mask using the given lasso coordinates
+    Generates a polygon mask using the given lasso coordinates. The mask only
+    covers the bounding box of the lasso, and it is cached for the same image
+    size and coordinates, so replaying a lasso action does not rasterize it
+    again.
     :param selectedData: The raw coordinates selected from the data
-    :return: The polygon mask generated from the given coordinate
+    :return: The bounding box of the lasso and the polygon mask generated from
+    the given coordinate inside that box, or (None, None) if it is empty
     """
 
     height = image.size[1]
-    y_coords = selectedData['lassoPoints']['y']
-    y_coords_corrected = [height - coord for coord in y_coords]
+    x_coords = np.asarray(selectedData['lassoPoints']['x'], dtype=float)
+    y_coords = np.asarray(selectedData['lassoPoints']['y'], dtype=float)
+    y_coords_corrected = height - y_coords
 
-    coordinates_tuple = list(zip(selectedData['lassoPoints']['x'], y_coords_corrected))
-    mask = Image.new('L', image.size)
-    draw = ImageDraw.Draw(mask)
-    draw.polygon(coordinates_tuple, fill=255)
+    points = np.column_stack((x_coords, y_coords_corrected))
+
+    if len(points) == 0:
+        return None, None
+
+    key = (image.size, hashlib.blake2b(points.tobytes(), digest_size=16).digest())
 
-    return mask
+    # The cached masks are shared by all the calls with the same key, so they
+    # must never be modified
+    with _lasso_masks_lock:
+        zone = _lasso_masks.get(key)
+        if zone is not None:
+            _lasso_masks.move_to_end(key)
+
+    if zone is not None:
+        metrics.count_cache('lasso_mask', 'hit')
+        return zone
+
+    # The mask is rasterized outside of the lock, so several threads may
+    # rasterize the same one
+    metrics.count_cache('lasso_mask', 'miss')
+    with metrics.timed('lasso_mask'):
+        zone = _rasterize_lasso(image.size, points)
+
+    _cache_lasso_mask(key, zone)
+
+    return zone
+
+
+def clear_lasso_masks():
+    global _lasso_mask_bytes
+
+    with _lasso_masks_lock:
+        _lasso_masks.clear()
+        _lasso_mask_bytes = 0
+
+
+def _mask_bytes(zone):
+    mask = zone[1]
+    return 0 if mask is None else mask.size[0] * mask.size[1]
+
+
+def _cache_lasso_mask(key, zone):
+    global _lasso_mask_bytes
+
+    # A mask larger than the whole budget would evict all the others
+    size = _mask_bytes(zone)
+    if size > LASSO_MASK_CACHE_BYTES:
+        return
+
+    with _lasso_masks_lock:
+        # Another thread may have cached the same mask meanwhile
+        if key in _lasso_masks:
+            return
+
+        _lasso_masks[key] = zone
+        _lasso_mask_bytes += size
+
+        while _lasso_mask_bytes > LASSO_MASK_CACHE_BYTES:
+            _, evicted = _lasso_masks.popitem(last=False)
+            _lasso_mask_bytes -= _mask_bytes(evicted)
+
+
+def get_selection_zone(image, selectedData):
+    """
+    Converts the data selected on the interactive image into the zone in
+    which an operation is applied.
+    :param selectedData: The JSON object that contains the zone selected by
+    the user, or None when the whole image is selected
+    :return: The selection mode, and the zone, which is a lasso mask or a box
+    """
+    im_size = image.size
+
+    # Select using Lasso
+    if selectedData and 'lassoPoints' in selectedData:
+        selection_mode = 'lasso'
+        selection_zone = generate_lasso_mask(image, selectedData)
+    # Select using rectangular box
+    elif selectedData and 'range' in selectedData:
+        selection_mode = 'select'
+        lower, upper = map(int, selectedData['range']['y'])
+        left, right = map(int, selectedData['range']['x'])
+        # Adjust height difference
+        height = im_size[1]
+        upper = height - upper
+        lower = height - lower
+        selection_zone = (left, upper, right, lower)
+    # Select the whole image
+    else:
+        selection_mode = 'select'
+        selection_zone = (0, 0) + im_size
+
+    return selection_mode, selection_zone
+
+
+def apply_action(image, action):
+    """
+    Applies an action of the action stack on the image, in-place.
+    :param action: The dict containing the operation, its type and the
+    selected data
+    """
+    operation = action['operation']
+    type = action['type']
+
+    selection_mode, selection_zone = get_selection_zone(
+        image, action['selectedData'])
+
+    # Apply the filters
+    if type == 'filter':
+        apply_filters(
+            image=image,
+            zone=selection_zone,
+            filter=operation,
+            mode=selection_mode
+        )
+    elif type == 'enhance':
+        enhancement = operation['enhancement']
+        factor = operation['enhancement_factor']
+
+        apply_enhancements(
+            image=image,
+            zone=selection_zone,
+            enhancement=enhancement,
+            enhancement_factor=factor,
+            mode=selection_mode
+        )
 
 
 def apply_filters(image, zone, filter, mode):
     filter_selected = FILTERS_DICT[filter]
 
+    # Only the selected region is filtered, with the margin required by the
+    # support radius of the filter
     if mode == 'select':
-        crop = image.crop(zone)
-        crop_mod = crop.filter(filter_selected)
-        image.paste(crop_mod, zone)
+        crop_mod = filter_region(image, zone, filter_selected)
+        if crop_mod is not None:
+            image.paste(crop_mod, zone)
 
     elif mode == 'lasso':
-        im_filtered = image.filter(filter_selected)
-        image.paste(im_filtered, mask=zone)
+        box, mask = zone
+        if box is None:
+            return
+
+        crop_mod = filter_region(image, box, filter_selected)
+        if crop_mod is not None:
+            image.paste(crop_mod, box, mask=mask)
 
 
 def apply_enhancements(image, zone, enhancement, enhancement_factor, mode):
@@ -82,7 +287,9 @@ def apply_enhancements(image, zone, enhancement, enhancement_factor, mode):
         image.paste(crop, box=zone)
 
     elif mode == 'lasso':
-        image.paste(im_enhanced, mask=zone)
+        box, mask = zone
+        if box is not None:
+            image.paste(im_enhanced.crop(box), box, mask=mask)
 
 
 def show_histogram(image):